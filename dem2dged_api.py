@@ -0,0 +1,153 @@
+import os,sys
+import time
+import dem2dged_lib as dl
+import dem2dged_utm
+import dem2dged_geo
+
+
+"""
+Python API for dem2dged. A DgedConverter is a conversion session for one input raster: the input
+dataset, the srs objects and the parsed sidecar template are kept alive between calls, so a long
+running process (e.g. a service) can plan, produce single tiles or run the whole product repeatedly
+without the start-up cost of the command line scripts. Every session keeps its own settings and open
+datasets; several sessions in one process (or one session used from several threads) take turns.
+
+    from dem2dged_api import DgedConverter
+    conv = DgedConverter("test.tif", "product_folder", grid="utm", product_level="5,4")
+    for level, tiles in conv.plan():
+        print(level, len(tiles))
+    conv.render_tile(conv.plan()[0][1][0])
+    conv.run(jobs=4)
+
+The project resides on github: https://github.com/lethorable/dem2dged - please observe the license in the repository
+"""
+
+#Options of a session and their defaults (the same as the command line options of the scripts)
+DEFAULT_OPTIONS = {'gdal_edit': False,
+                   'strip_mb': 0,
+                   'timing_log': None,
+                   'co_profile': 'lzw',
+                   'blocksize': 256,
+                   'overviews': None,
+                   'warp_threads': 0,
+                   'warp_mem': 0,
+                   'cache_mb': 0,
+                   'writer_threads': 0,
+                   'volume_mb': 0,
+                   'keywords': None}
+
+class DgedConverter(object):
+    """
+    A conversion session. grid is 'utm' or 'geo', product_level one or more levels (comma separated),
+    utm_zone as the -utm_zone option (UTM only). Further options (see DEFAULT_OPTIONS) are given as
+    keyword arguments, e.g. co_profile='deflate' or strip_mb=512
+    """
+    def __init__(self, input_raster, output_folder, grid="utm", product_level="5", utm_zone="autodetect",
+                 xml_template=None, source_type="A", sec_class="U", prod_ver="01", prune=True, verbose=False, **options):
+        if grid not in ('utm', 'geo'):
+            raise ValueError("grid must be 'utm' or 'geo', not %s" %(grid))
+        unknown = set(options) - set(DEFAULT_OPTIONS)
+        if unknown:
+            raise ValueError("Unknown option(s): %s" %(", ".join(sorted(unknown))))
+        if xml_template is None:
+            xml_template = os.path.join(os.path.dirname(os.path.abspath(__file__)), #next to this module, not in the working directory
+                                        "DGED_UTM_TEMPLATE.xml" if grid == 'utm' else "DGED_GEO_TEMPLATE.xml")
+        self.input_raster = input_raster
+        self.output_folder, self.archive = dl.split_output(output_folder) #a .zip or .tar is written as an archive
+        self.grid = grid
+        self.product_level = product_level
+        self.utm_zone = utm_zone
+        self.source_type = source_type
+        self.sec_class = sec_class
+        self.prod_ver = prod_ver
+        self.prune = prune
+        self.verbose = verbose
+        self.options = dict(DEFAULT_OPTIONS)
+        self.options.update(options)
+        self.template = dl.read_sidecar_template(xml_template) #parsed once for the session
+        dl.compile_sidecar_template(self.template, self.options['keywords'] or {}) #raises ValueError for unknown keywords
+        self.sources = {} #datasets opened by this session (see dem2dged_lib.session_state)
+        with dl.session_state(self.run_settings(), self.sources):
+            self.source = dl.open_source(input_raster) #kept open for the session
+        self.level_tiles = None
+        if not os.path.exists(self.output_folder):
+            os.makedirs(self.output_folder)
+
+    def plan(self, refresh=False):
+        """
+        The tiles of all levels are planned (once for the session, unless refresh is set).
+        Returns a list of (level, tiles) with the finest level first
+        """
+        if self.level_tiles is None or refresh:
+            with dl.session_state(self.run_settings(), self.sources):
+                started = time.time()
+                if self.grid == 'utm':
+                    self.level_tiles = dem2dged_utm.plan_product(self.input_raster, self.product_level, self.utm_zone,
+                                                                 self.source_type, self.sec_class, self.prod_ver, self.prune)
+                else:
+                    self.level_tiles = dem2dged_geo.plan_product(self.input_raster, self.product_level,
+                                                                 self.source_type, self.sec_class, self.prod_ver, self.prune)
+                dl.add_stage_time('planning', time.time() - started)
+        return self.level_tiles
+
+    def write_plan(self, fnam):
+        """
+        The plan is written to fnam (.csv, .json or .gpkg). Returns the number of tiles
+        """
+        return dl.write_plan(self.plan(), fnam)
+
+    def run_settings(self, jobs=1):
+        """
+        The run settings (see dem2dged_lib.settings) of the session for a number of jobs
+        """
+        warp_threads, warp_mem, cache_mb = dl.resolve_resources(jobs, self.options['warp_threads'], self.options['warp_mem'], self.options['cache_mb'])
+        run_settings = dict(self.options)
+        run_settings.update({'input_raster': self.input_raster,
+                             'output_folder': self.output_folder,
+                             'archive': self.archive,
+                             'template': self.template,
+                             'distributed': False,
+                             'node_id': None,
+                             'lease_sec': 600,
+                             'warp_threads': warp_threads,
+                             'warp_mem': warp_mem,
+                             'cache_mb': cache_mb,
+                             'keep_open': [self.input_raster],
+                             'verbose': self.verbose})
+        return run_settings
+
+    def estimate(self, jobs=1, sample=8):
+        """
+        Tile count, output size and wall time of run() are estimated (see dem2dged_lib.estimate_run)
+        """
+        level_tiles = self.plan()
+        run_settings = self.run_settings(jobs)
+        with dl.session_state(run_settings, self.sources):
+            return dl.estimate_run(level_tiles, run_settings, jobs, sample)
+
+    def render_tile(self, tile):
+        """
+        A single planned tile is produced from the input raster (the manifest is not updated).
+        Returns the result dict (basename, state, timings, bytes, checksum and error if failed).
+        If the output is an archive the tile is not added to it, the result holds the tif bytes
+        (data) and the sidecar text (sidecar) instead
+        """
+        with dl.session_state(self.run_settings(), self.sources):
+            return dl.render_tile(tile, self.source)
+
+    def run(self, jobs=1, incremental=False):
+        """
+        All planned levels are produced (tiles already done in the output folder are skipped).
+        Returns the number of failed tiles
+        """
+        level_tiles = self.plan()
+        run_settings = self.run_settings(jobs)
+        with dl.session_state(run_settings, self.sources):
+            return dl.run_levels(level_tiles, run_settings, jobs, incremental)
+
+    def close(self):
+        """
+        The datasets of the session are released (those of other sessions stay open)
+        """
+        self.source = None
+        self.sources.clear()
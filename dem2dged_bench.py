@@ -0,0 +1,193 @@
+import argparse
+import os,sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import contextlib
+import multiprocessing
+import numpy as np
+from osgeo import gdal,osr
+import dem2dged_lib as dl
+import dem2dged_utm
+import dem2dged_geo
+try:
+    import resource #not available on windows
+except ImportError:
+    resource = None
+
+parser = argparse.ArgumentParser(description="Benchmark the UTM and GEO pipelines on synthetic DEMs of increasing size and on test.tif. Results are written as JSON and can be compared between commits")
+parser.add_argument("-sizes",dest="sizes",help="Sizes (pixels per side) of the synthetic DEMs, comma separated (default is 1000,2500,5000)",default="1000,2500,5000")
+parser.add_argument("-pixel_size",dest="pixel_size",type=float,help="Pixel size of the synthetic DEMs in m (default is 2)",default=2.0)
+parser.add_argument("-levels",dest="levels",help="Product levels to run, comma separated (default is 5,6)",default="5,6")
+parser.add_argument("-grids",dest="grids",help="Pipelines to run: utm, geo or both (default is utm,geo)",default="utm,geo")
+parser.add_argument("-no_test_tif",action="store_true",help="Do not include test.tif")
+parser.add_argument("-jobs",dest="jobs",type=int,help="Passed on to the pipelines (default is 1)",default=1)
+parser.add_argument("-extra",dest="extra",help="Extra arguments passed on to the pipelines, e.g. \"-strip_mb 512\"",default="")
+parser.add_argument("-work_dir",dest="work_dir",help="Folder for synthetic inputs and outputs (default is bench_work)",default="bench_work")
+parser.add_argument("-out",dest="out",help="JSON file for the results (default is bench_results.json)",default="bench_results.json")
+parser.add_argument("-compare",dest="compare",help="JSON results of an earlier benchmark to compare with")
+parser.add_argument("-keep_output",action="store_true",help="Keep the produced tiles")
+parser.add_argument("-verbose",action="store_true",help="Show additional output")
+
+
+"""
+Benchmark suite for dem2dged. Each case (input, pipeline, level) runs in its own process so peak
+memory can be measured. Recorded are tiles per second, wall time per stage (planning, warp, write,
+header, sidecar), peak RSS and output bytes.
+"""
+
+def create_synthetic_dem(fnam, size, pixel_size):
+    """
+    A synthetic Float32 DEM in EPSG:25832 (UTM 32N, ETRS89) with smooth terrain, noise and
+    a void in one corner (so the footprint handling is exercised)
+    """
+    x = np.arange(size, dtype=np.float32)
+    y = np.arange(size, dtype=np.float32)[:, None]
+    dem = 50 + 30*np.sin(x*pixel_size/300.0)*np.cos(y*pixel_size/500.0) + 0.01*(x+y)*pixel_size
+    dem = dem + np.random.default_rng(42).normal(0, 0.2, (size, size)).astype(np.float32)
+    dem[:size//4, :size//4] = -32767
+    drv = gdal.GetDriverByName('GTiff')
+    ds = drv.Create(fnam, size, size, 1, gdal.GDT_Float32, options=['COMPRESS=LZW', 'TILED=YES'])
+    ds.SetGeoTransform((600000.0, pixel_size, 0, 6200000.0, 0, -pixel_size))
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(25832)
+    ds.SetProjection(srs.ExportToWkt())
+    band = ds.GetRasterBand(1)
+    band.SetNoDataValue(-32767)
+    band.WriteArray(dem.astype(np.float32))
+    ds = None
+
+def folder_bytes(folder):
+    """
+    Total size of the tiles and sidecars in a folder
+    """
+    total = 0
+    for fnam in os.listdir(folder):
+        if fnam.endswith('.tif') or fnam.endswith('.xml'):
+            total = total + os.path.getsize(os.path.join(folder, fnam))
+    return total
+
+def peak_rss_mb():
+    """
+    Peak resident memory of this process and its (finished) children in MB
+    """
+    if resource is None:
+        return None
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1024*1024 if sys.platform == 'darwin' else 1024 #bytes on mac, kB on linux
+    return max(self_rss, child_rss)/scale
+
+def run_case(case, queue):
+    """
+    A single case is run (in a separate process) and the measurements are put on the queue
+    """
+    script = dem2dged_utm if case['grid'] == 'utm' else dem2dged_geo
+    args = [script.__file__, case['input'], case['output'], '-product_level', case['level'], '-jobs', str(case['jobs'])]
+    args = args + case['extra'].split()
+    if case['verbose']:
+        args.append('-verbose')
+    dl.stage_totals.clear()
+    started = time.time()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull if not case['verbose'] else sys.stdout):
+        script.main(args)
+    wall = time.time() - started
+    tiles = dl.stage_totals.pop('tiles', 0)
+    queue.put({'wall_s': wall,
+               'tiles': tiles,
+               'tiles_per_s': tiles/wall if wall > 0 else None,
+               'stages_s': dict(dl.stage_totals),
+               'peak_rss_mb': peak_rss_mb(),
+               'output_bytes': folder_bytes(case['output'])})
+
+def git_commit():
+    """
+    The current commit of the repository (if available)
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+def compare(results, fnam):
+    """
+    Tiles per second and wall time are compared with an earlier benchmark
+    """
+    with open(fnam) as f:
+        previous = dict((r['name'], r) for r in json.load(f)['results'])
+    print("%-40s %12s %12s %8s" %("case", "tiles/s", "before", "ratio"))
+    for r in results:
+        p = previous.get(r['name'])
+        if p is None or not p.get('tiles_per_s') or not r.get('tiles_per_s'):
+            continue
+        print("%-40s %12.3f %12.3f %8.2f" %(r['name'], r['tiles_per_s'], p['tiles_per_s'], r['tiles_per_s']/p['tiles_per_s']))
+
+def main(args):
+    pargs = parser.parse_args(args[1:])
+    dl.debug = pargs.verbose
+    if not os.path.exists(pargs.work_dir):
+        os.makedirs(pargs.work_dir)
+
+    inputs = []
+    for size in [int(v) for v in pargs.sizes.split(',') if v]:
+        fnam = os.path.join(pargs.work_dir, "synthetic_%s.tif" %(size))
+        if not os.path.isfile(fnam):
+            print("Creating synthetic DEM %s" %(fnam))
+            create_synthetic_dem(fnam, size, pargs.pixel_size)
+        inputs.append(("synthetic_%s" %(size), fnam))
+    test_tif = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test.tif')
+    if not pargs.no_test_tif and os.path.isfile(test_tif):
+        inputs.append(("test_tif", test_tif))
+
+    results = []
+    ctx = multiprocessing.get_context('spawn') #a fresh process per case for honest memory figures
+    for name, fnam in inputs:
+        for grid in pargs.grids.split(','):
+            for level in pargs.levels.split(','):
+                case = {'name': "%s_%s_L%s" %(name, grid, level),
+                        'input': os.path.abspath(fnam),
+                        'grid': grid,
+                        'level': level,
+                        'jobs': pargs.jobs,
+                        'extra': pargs.extra,
+                        'verbose': pargs.verbose,
+                        'output': os.path.join(pargs.work_dir, "out_%s_%s_L%s" %(name, grid, level))}
+                if os.path.exists(case['output']):
+                    shutil.rmtree(case['output'])
+                queue = ctx.Queue()
+                p = ctx.Process(target=run_case, args=(case, queue))
+                p.start()
+                while True:
+                    try:
+                        measured = queue.get(timeout=5)
+                        break
+                    except Exception: #queue.Empty
+                        if not p.is_alive():
+                            raise RuntimeError("Benchmark case %s failed" %(case['name']))
+                p.join()
+                case.update(measured)
+                del case['verbose']
+                results.append(case)
+                print("%-40s %6s tiles %8.2f s %8.3f tiles/s" %(case['name'], case['tiles'], case['wall_s'], case['tiles_per_s'] or 0))
+                if not pargs.keep_output:
+                    shutil.rmtree(case['output'])
+
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'commit': git_commit(),
+              'gdal_version': gdal.__version__,
+              'python_version': platform.python_version(),
+              'platform': platform.platform(),
+              'cpu_count': os.cpu_count(),
+              'results': results}
+    with open(pargs.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("Results written to %s" %(pargs.out))
+    if pargs.compare:
+        compare(results, pargs.compare)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -4,16 +4,42 @@ import math
 from osgeo import gdal,ogr,osr
 import subprocess
 import datetime
+import time
+import numpy as np
 import dem2dged_lib as dl
 
 parser = argparse.ArgumentParser(description="Convert a DEM to DGED GEO. The script reads a GDAL raster source and based on user input creates a set of tiles compatible with DGIWG/DGED")
-parser.add_argument("input_raster", help="Elevation raster. Must be valid gdal source (geotiff, vrt, etc.)")
-parser.add_argument("output_folder", help="Output path to the generated product")
-parser.add_argument("-product_level",dest="product_level",help="For UTM output must be 4b, 4, 5, 6, 7, 8 or 9 (default is level 5, GSD ~ 2 m)",default="5")
+parser.add_argument("input_raster", help="Elevation raster. Must be valid gdal source (geotiff, vrt, etc.). Several rasters in the same srs can be given as a comma separated list, a directory, a glob pattern (quoted) or a .txt file with one raster per line")
+parser.add_argument("output_folder", help="Output path to the generated product. A path ending in .zip or .tar is an archive the tiles and sidecars are written into as they are produced")
+parser.add_argument("-product_level",dest="product_level",help="For UTM output must be 4b, 4, 5, 6, 7, 8 or 9 (default is level 5, GSD ~ 2 m). Several levels can be given as a comma separated list (e.g. 5,3,2) - coarser levels are then derived from the finest",default="5")
 parser.add_argument("-xml_template",dest="xml_template",help="Template for sidecar xml file. Default to DGED_GEO_TEMPLATE.xml included in project",default="DGED_GEO_TEMPLATE.xml")
+parser.add_argument("-precedence",dest="precedence",choices=['order', 'newest', 'finest'],help="Which of several input rasters wins where they overlap: the last given (order, default), the newest file (newest) or the finest resolution (finest)",default="order")
+parser.add_argument("-keyword",dest="keyword",action="append",help="Extra keyword for the sidecar template as NAME=VALUE, replacing {{NAME}} (can be given several times)")
 parser.add_argument("-source_type", dest="source_type", help="Source type code must be a letter according to the DGED specification (default is A = optical unedited reflective surface)", default="A")
 parser.add_argument("-security_class", dest="sec_class", help="Security classification must be T, S, C, R or U (default is U)", default="U")
 parser.add_argument("-product_version", dest="prod_ver", help="Product version must be a 2 digits code (default is 01)", default="01")
+parser.add_argument("-jobs",dest="jobs",type=int,help="Number of tiles produced in parallel (default is 1)",default=1)
+parser.add_argument("-warp_threads",dest="warp_threads",type=int,help="Threads used for warping each tile (default is 0 = number of cores divided by -jobs)",default=0)
+parser.add_argument("-warp_mem",dest="warp_mem",type=int,help="Working memory of the warper in MB (default is 0 = a share of the physical memory)",default=0)
+parser.add_argument("-cache_mb",dest="cache_mb",type=int,help="GDAL block cache per process in MB (default is 0 = a share of the physical memory)",default=0)
+parser.add_argument("-writer_threads",dest="writer_threads",type=int,help="Threads compressing and writing finished tiles while the next tiles are warped (default is 0 = warp and write in turn)",default=0)
+parser.add_argument("-volume_mb",dest="volume_mb",type=int,help="Split an archive output into volumes of at most this many MB, named <archive>_001.zip, <archive>_002.zip and so on (default is 0 = one archive)",default=0)
+parser.add_argument("-strip_mb",dest="strip_mb",type=int,help="Read the source for a whole row of tiles at a time into a buffer of at most this many MB (default is 0 = read for each tile)",default=0)
+parser.add_argument("-incremental",action="store_true",help="Only produce the tiles touched by input sources (e.g. vrt members) changed since the last run into the output folder")
+parser.add_argument("-distributed",action="store_true",help="Cooperate with other nodes (hosts or processes) running the same command on the same output folder. Work is claimed through lock files in the output folder")
+parser.add_argument("-node_id",dest="node_id",help="Name of this node in distributed mode (default is hostname_pid)",default=dl.default_node_id())
+parser.add_argument("-lease_sec",dest="lease_sec",type=int,help="Claims of nodes not heard from within this many seconds are taken over in distributed mode (default is 600)",default=600)
+parser.add_argument("-no_prune",action="store_true",help="Produce all tiles within the bounding box, also tiles that do not intersect the input data")
+parser.add_argument("-co_profile",dest="co_profile",choices=sorted(dl.CREATION_PROFILES),help="GeoTIFF creation profile of the output tiles: lzw (default, LZW in strips as before), lzw_pred, deflate or zstd (predictor and internal tiling) or none",default="lzw")
+parser.add_argument("-blocksize",dest="blocksize",type=int,help="Block size of internally tiled profiles (default is 256)",default=256)
+parser.add_argument("-overviews",dest="overviews",help="Internal overview factors, comma separated e.g. 2,4,8 (default is none)")
+parser.add_argument("-plan_out",dest="plan_out",help="Only plan the tiles and write the complete plan (name, level, srs, bounds and resolution of every tile) to this file instead of producing the product. The format follows the extension: .csv, .json or .gpkg")
+parser.add_argument("-dry_run",action="store_true",help="Only estimate the number of tiles (and non-empty tiles), the output size and the wall time of the run. The estimate is calibrated on a sample of real tiles written to a temporary folder")
+parser.add_argument("-sample_tiles",dest="sample_tiles",type=int,help="Number of tiles per level sampled by -dry_run (default is 8, 0 = tile count and uncompressed size only)",default=8)
+parser.add_argument("-compare_profiles",dest="compare_profiles",type=int,help="Compare size, write and read time of the creation profiles on this many sample tiles instead of producing the product",default=0)
+parser.add_argument("-gdal_edit",action="store_true",help="Adjust the tiff header afterwards with the bundled gdal_edit.py (fallback if AREA_OR_POINT=Point is missing in the output)")
+parser.add_argument("-timing_log",dest="timing_log",help="Write the timing of every stage of every tile as JSON lines to this file and print a summary (p50, p95, max per stage and the slowest tiles) at the end")
+parser.add_argument("-profile",dest="profile",help="Run under cProfile and write the statistics to this file (only the main process is profiled, not the -jobs workers)")
 parser.add_argument("-verbose",action="store_true",help="Show additional output")
 
 
@@ -64,90 +90,187 @@ def resolve_level_geo(lvl):
             tile_size_letter = l[3]
     return tile_size, geo_res, tile_size_letter
 
-def main(args):
-    my_out_srs = 4326 #we will hardcode this here - constant for this product
-    pargs = parser.parse_args(args[1:])
-    dl.debug = pargs.verbose #if verbose is set, output will be printed using the dl.dp() funcion
+def dms_name_parts(values, level, width):
+    """
+    The DMS parts of the tile names for an array of (tile corner) degrees, as ToDMS and the
+    legacy formatting would give them: degrees, minutes for level 4b-6 and seconds for finer levels.
+    Returns a list of strings
+    """
+    dd = np.asarray(values, dtype=np.float64)
+    dd1 = np.abs(dd)
+    deg = np.trunc(dd1)
+    minsec = dd1 - deg
+    mins = np.trunc(minsec * 60)
+    secs = np.trunc((minsec % 60) / float(3600))
+    deg = np.where(dd < 0, -deg, deg)
+    parts = []
+    for d, m, sec in zip(deg.tolist(), mins.tolist(), secs.tolist()):
+        part = str(int(d)).rjust(width, "0")
+        if level not in ['0', '1', '2', '3']:
+            part = part + str(int(m)).rjust(2, "0")
+            if level not in ['4b', '4', '5', '6']:
+                part = part + str(int(sec)).rjust(2, "0")
+        parts.append(part)
+    return parts
 
-    #create output folder if it does not exist
-    if not os.path.exists(pargs.output_folder):
-        os.makedirs(pargs.output_folder)
+def lon_multiplication_table(minlats):
+    """
+    resolve_lon_multiplication for an array of latitudes at once (a lookup in the latitude bands)
+    """
+    starts = np.array([l[1] for l in dl.zone_lon_spacing], dtype=np.float64)
+    factors = np.array([1] + [l[4] for l in dl.zone_lon_spacing], dtype=np.float64)
+    return factors[np.searchsorted(starts, minlats, side='right')]
 
-    template = dl.read_sidecar_template(pargs.xml_template) #The template is read. Keywords are marked with {{KEYWORD}}
+def plan_tiles_geo(bbox, level, source_type, sec_class, prod_ver):
+    """
+    The tiles covering the bounding box (minlat, maxlat, minlon, maxlon) are planned.
+    Bounds, post spacing and names are computed for the whole grid at once: the names are combined
+    from a table of latitude parts (one per row) and longitude parts (one per column).
+    Returns a list of tiles (dicts) with basename, bounds (minlon, minlat, maxlon, maxlat) and resolution
+    """
+    my_out_srs = 4326
+    minx, maxx, miny, maxy = bbox
+    tiledim, latres, tile_size_letter = resolve_level_geo(level)
+    dl.dp ("tile dimension %s " %tiledim)
+    dl.dp ("longitude resolution %s" %latres)
+
+    #Determine iteration bounds. We need to take extra care (compared to UTM) as the input dataset may cross a critical latitude
+    ilon_start = math.floor(miny/tiledim)
+    ilon_end   = math.floor(maxy/tiledim)+1
+    ilat_start = math.floor(minx/tiledim)
+    ilat_end   = math.floor(maxx/tiledim)+1
+    if ilat_end <= ilat_start or ilon_end <= ilon_start:
+        return []
+
+    yys = np.arange(ilat_start, ilat_end)
+    xxs = np.arange(ilon_start, ilon_end)
+    minlats = yys * tiledim
+    maxlats = (yys+1) * tiledim + latres
+    lonress = lon_multiplication_table(minlats) * latres #per row
+    minlons = xxs * tiledim
+    maxlons = (xxs+1) * tiledim #+ lonres of the row (hanging pixel)
 
-    my_in_ext = dl.get_extent_and_srs_of_input_raster(pargs.input_raster)
+    # Hemisphere (N or S) and eastern or western part (E or W). As in the original tile loop the
+    # letter of the first (south western) tile is used for all tiles of the grid
+    hemi = "S" if minlats[0] < 0 else "N"
+    east = "W" if minlons[0] < 0 else "E"
+
+    prefix = "DGEDL%sGt%s_" %(level, tile_size_letter)
+    suffix = "_%s_%s_%s" %(source_type, sec_class, prod_ver)
+    lat_names = np.array([prefix + part + hemi for part in dms_name_parts(minlats, level, 2)])
+    lon_names = np.array([part + east + suffix for part in dms_name_parts(minlons, level, 3)])
+    basenames = np.char.add(lat_names[:, None], lon_names[None, :])
+
+    tiles = []
+    for iy, (yy, minlat, maxlat, lonres) in enumerate(zip(yys.tolist(), minlats.tolist(), maxlats.tolist(), lonress.tolist())):
+        row_names = basenames[iy].tolist()
+        for ix, (minlon, maxlon) in enumerate(zip(minlons.tolist(), maxlons.tolist())):
+            tiles.append({'basename': row_names[ix],
+                          'level': level,
+                          'row': yy,
+                          'epsg': my_out_srs,
+                          'bounds': (minlon, minlat, maxlon + lonres, maxlat),
+                          'xres': lonres,
+                          'yres': latres,
+                          'gsd': lonres}) #lonres input as dummy - not used for GEO
+    return tiles
+
+def plan_product(input_raster, product_level="5", source_type="A", sec_class="U", prod_ver="01", prune=True):
+    """
+    The tiles of one or more product levels (comma separated) are planned for the input raster
+    (see the parser for the arguments). With prune the tiles not intersecting the input data are left out.
+    Returns a list of (level, tiles) with the finest level first
+    """
+    my_out_srs = 4326 #we will hardcode this here - constant for this product
+    my_in_ext = dl.get_extent_and_srs_of_input_raster(input_raster)
 
     minx, maxx, miny, maxy = dl.get_bbox_of_output(my_in_ext,my_out_srs)
 
     dl.dp ("bounding box for output has been calculated to %s %s %s %s " %(minx, maxx, miny, maxy)) #Returns N, E
 
-    tiledim, latres, tile_size_letter = resolve_level_geo(pargs.product_level)
-    dl.dp ("tile dimension %s " %tiledim)
-    dl.dp ("longitude resolution %s" %latres)
+    levels = sorted(product_level.split(','), key=lambda lvl: resolve_level_geo(lvl)[1]) #finest level first
+    if prune:
+        footprint = dl.get_footprint_of_input_raster(input_raster, my_out_srs)
+    level_tiles = []
+    for level in levels:
+        tiles = plan_tiles_geo((minx, maxx, miny, maxy), level, source_type, sec_class, prod_ver)
+        if prune:
+            numplanned = len(tiles)
+            tiles, numpruned = dl.prune_tiles(tiles, footprint)
+            print("Level %s: %s of %s planned tiles do not intersect the input data and are skipped" %(level, numpruned, numplanned))
+        level_tiles.append((level, tiles))
+    return level_tiles
 
-    # Northern or southern hemisphere (N or S)
-    hemi = "N"
+def main(args):
+    pargs = parser.parse_args(args[1:])
+    if pargs.profile:
+        return dl.run_profiled(convert, pargs, pargs.profile)
+    return convert(pargs)
 
-    # Eastern or western part (E or W)
-    east = "E"
+def convert(pargs):
+    """
+    The conversion itself (see the parser for the arguments)
+    """
+    dl.debug = pargs.verbose #if verbose is set, output will be printed using the dl.dp() funcion
+    if pargs.distributed and pargs.incremental:
+        parser.error("-incremental can not be combined with -distributed")
+    output_folder, archive = dl.split_output(pargs.output_folder)
+    if archive is not None and (pargs.distributed or pargs.incremental or pargs.gdal_edit):
+        parser.error("an archive output can not be combined with -distributed, -incremental or -gdal_edit")
 
-    #Determine iteration bounds. We need to take extra care (compared to UTM) as the input dataset may cross a critical latitude
-    ilon_start = math.floor(miny/tiledim)
-    ilon_end   = math.floor(maxy/tiledim)+1
-    ilat_start = math.floor(minx/tiledim)
-    ilat_end   = math.floor(maxx/tiledim)+1
+    #create output folder if it does not exist
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    template = dl.read_sidecar_template(pargs.xml_template) #The template is read. Keywords are marked with {{KEYWORD}}
+    keywords = dict(k.split('=', 1) for k in pargs.keyword or [] if '=' in k)
+    try:
+        dl.compile_sidecar_template(template, keywords) #every keyword must be known before tiles are produced
+    except ValueError as e:
+        parser.error(str(e))
+    planning_started = time.time()
+    input_raster, input_sources = dl.prepare_inputs(pargs.input_raster, pargs.precedence)
+    if input_sources:
+        print("%s input rasters are converted into one tile grid" %(len(input_sources)))
 
-    numdone = 0
-    numfiles = (ilon_end-ilon_start)*(ilat_end-ilat_start)
-    for yy in range(ilat_start, ilat_end):
-        for xx in range(ilon_start, ilon_end):
-            numdone = numdone +1
-            percentage = int(100*numdone/numfiles)
-            minlat = yy    * (tiledim)
-            lonres = resolve_lon_multiplication(minlat) * latres
-            maxlat = (yy+1) * (tiledim) + latres
-
-            maxlon = (xx+1) * (tiledim) + lonres#hanging pixel
-            minlon = xx      * (tiledim)
-
-            # If we are on another hemisphere than the NE
-            if minlat < 0:
-                hemi = "S"
-
-            if minlon < 0:
-                east = "W"
-
-            minlatdms = ToDMS(minlat)
-            minlondms = ToDMS(minlon)
-
-            dl.dp ("%s %s %s %s "%(minlon, maxlon, minlat, maxlat))
-            basename = "DGEDL%sGt%s_%s%s%s%s%s%s%s%s_%s_%s_%s" %(pargs.product_level,tile_size_letter,str(int(minlatdms[0])).rjust(2,"0"),str(int(minlatdms[1])).rjust(2,"0"),str(int(minlatdms[2])).rjust(2,"0"), hemi,str(int(minlondms[0])).rjust(3,"0"),str(int(minlondms[1])).rjust(2,"0"),str(int(minlondms[2])).rjust(2,"0"), east, pargs.source_type, pargs.sec_class, pargs.prod_ver) #should this be invoked from command line?
-            if pargs.product_level in ['0', '1', '2', '3']:
-                basename = "DGEDL%sGt%s_%s%s%s%s_%s_%s_%s" %(pargs.product_level,tile_size_letter,str(int(minlatdms[0])).rjust(2,"0"), hemi,str(int(minlondms[0])).rjust(3,"0"), east, pargs.source_type, pargs.sec_class, pargs.prod_ver) #should this be invoked from command line?
-            if pargs.product_level in ['4b', '4', '5', '6']:
-                basename = "DGEDL%sGt%s_%s%s%s%s%s%s_%s_%s_%s" %(pargs.product_level,tile_size_letter,str(int(minlatdms[0])).rjust(2,"0"),str(int(minlatdms[1])).rjust(2,"0"), hemi,str(int(minlondms[0])).rjust(3,"0"),str(int(minlondms[1])).rjust(2,"0"), east, pargs.source_type, pargs.sec_class, pargs.prod_ver) #should this be invoked from command line?
-            namnam = os.path.join(pargs.output_folder,basename+'.tif')
-            xmlnam = os.path.join(pargs.output_folder,basename+'.xml')
-
-            if os.path.isfile(xmlnam):
-                print("file %s already exists, continuing (consider to delete before running)" %(xmlnam)) #maybe an option - overwrite or continue? As it is now it allows to continue of the process breaks.
-                continue
-
-            dl.dp(" ")
-            dl.dp("-"*70)
-            dl.dp("Creating elevation raster %s" %(namnam))
-            cmdstr = """gdalwarp -t_srs EPSG:%s+3855 -te %s %s %s %s -dstnodata -32767 -tr %s %s -r cubic -co COMPRESS=LZW --config GTIFF_REPORT_COMPD_CS YES %s %s""" %(my_out_srs, minlon, minlat, maxlon, maxlat, lonres, latres, pargs.input_raster, namnam )
-            dl.dp (cmdstr)
-            dl.run_cmd(cmdstr)
-            dl.dp("Adjusting tiff header")
-            cmdstr = """python gdal_edit.py --config GTIFF_REPORT_COMPD_CS YES -a_srs epsg:%s+3855 -mo AREA_OR_POINT=POINT %s""" %(my_out_srs,namnam)
-            dl.dp (cmdstr)
-            dl.run_cmd(cmdstr)
-            dl.dp("creating sidecar metadata file")
-            dl.write_sidecar_file(template, xmlnam,basename,pargs.product_level,lonres,"EPSG:"+str(my_out_srs)) #lonres input as dummy - not used for GEO
-            dl.dp("-"*70)
-            dl.dp(" ")
-            print ("%s %% done " %(percentage))
+    level_tiles = plan_product(input_raster, pargs.product_level, pargs.source_type, pargs.sec_class, pargs.prod_ver, not pargs.no_prune)
+    dl.add_stage_time('planning', time.time() - planning_started)
+    if pargs.plan_out:
+        numtiles = dl.write_plan(level_tiles, pargs.plan_out)
+        print("Plan of %s tiles written to %s" %(numtiles, pargs.plan_out))
+        return
+    warp_threads, warp_mem, cache_mb = dl.resolve_resources(pargs.jobs, pargs.warp_threads, pargs.warp_mem, pargs.cache_mb)
+    dl.dp ("%s job(s) with %s warp thread(s), %s MB warp memory and %s MB block cache each" %(pargs.jobs, warp_threads, warp_mem, cache_mb))
+    run_settings = {'input_raster': input_raster,
+                    'input_sources': input_sources,
+                    'output_folder': output_folder,
+                    'archive': archive,
+                    'volume_mb': pargs.volume_mb,
+                    'template': template,
+                    'gdal_edit': pargs.gdal_edit,
+                    'strip_mb': pargs.strip_mb,
+                    'distributed': pargs.distributed,
+                    'node_id': pargs.node_id,
+                    'lease_sec': pargs.lease_sec,
+                    'timing_log': pargs.timing_log,
+                    'co_profile': pargs.co_profile,
+                    'warp_threads': warp_threads,
+                    'warp_mem': warp_mem,
+                    'cache_mb': cache_mb,
+                    'writer_threads': pargs.writer_threads,
+                    'keywords': keywords,
+                    'blocksize': pargs.blocksize,
+                    'overviews': [int(f) for f in pargs.overviews.split(',')] if pargs.overviews else None,
+                    'verbose': pargs.verbose}
+    if pargs.dry_run:
+        dl.estimate_run(level_tiles, run_settings, pargs.jobs, pargs.sample_tiles)
+        return
+    if pargs.compare_profiles > 0:
+        dl.compare_creation_profiles(dl.random_tiles(level_tiles[0][1], pargs.compare_profiles), run_settings)
+        return
+    dl.run_levels(level_tiles, run_settings, pargs.jobs, pargs.incremental)
+    if pargs.timing_log:
+        dl.print_timing_summary()
     print("All done!")
 
 if __name__ == "__main__":
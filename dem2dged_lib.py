@@ -1,8 +1,32 @@
 import os,sys
+import re
 import math
 from osgeo import gdal,ogr,osr
+import numpy as np
 import subprocess
 import datetime
+import multiprocessing
+import xml.etree.ElementTree as ET
+import sqlite3
+import threading
+import hashlib
+import json
+import csv
+import glob
+import time
+import socket
+import cProfile
+import pstats
+import tempfile
+import shutil
+import random
+import collections
+import contextlib
+import queue
+import io
+import zipfile
+import tarfile
+import struct
 
 #*--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--*
 #Following arrays are for converting to GEO
@@ -74,20 +98,47 @@ def read_sidecar_template(template_fnam): #UNCHANGED
         template = f.read()
     return template
 
-def write_sidecar_file(template, fnam, basename, level, gsd, epsg): #UNCHANGED
+#Keywords filled for every tile. Further keywords can be given with -keyword NAME=VALUE
+SIDECAR_KEYWORDS = ['BASENAME', 'LEVEL', 'GSD', 'DATE', 'EPSG', 'MIN_ELEV', 'MAX_ELEV', 'MEAN_ELEV', 'VOID_PCT',
+                    'MINX', 'MINY', 'MAXX', 'MAXY', 'CHECKSUM']
+KEYWORD_PATTERN = re.compile(r'{{([^{}]*)}}')
+#The vertical extent of a tile without data is given as missing (ISO nil) instead of a number
+NIL_EXTENT_PATTERN = re.compile(r'<gmd:(minimumValue|maximumValue)>\s*<gco:Real>\s*{{(?:MIN|MAX)_ELEV}}\s*</gco:Real>\s*</gmd:\1>')
+compiled_templates = {} #compiled sidecar templates by template text
+nil_templates = {} #templates for tiles without data by template text
+
+def compile_sidecar_template(template, extra_keywords=()):
+    """
+    The template is split once into literal text and keywords, so a sidecar is rendered in a single
+    pass. Raises ValueError for keywords that are neither filled per tile nor given as extra keywords.
+    Returns a list alternating literal text and keyword names (literals at even positions)
+    """
+    parts = KEYWORD_PATTERN.split(template)
+    unknown = sorted(set(parts[1::2]) - set(SIDECAR_KEYWORDS) - set(extra_keywords))
+    if unknown:
+        raise ValueError("Unknown keyword(s) in the sidecar template: %s" %(", ".join("{{%s}}" %(k) for k in unknown)))
+    return parts
+
+def render_sidecar(template, keywords):
     """
-    The sidecar xml file is written. Keywords marked with {{KEYWORD}}
-    are replaced in the output.
+    The sidecar text of a tile. The template is compiled on first use (see compile_sidecar_template).
+    Raises ValueError if a keyword of the template has no value
     """
-    today = datetime.date.today()
-    dp (today)
-    with open(fnam, "wt") as f:
-        xfile = template.replace('{{BASENAME}}',basename)
-        xfile =    xfile.replace('{{LEVEL}}',level)
-        xfile =    xfile.replace('{{GSD}}',str(gsd))
-        xfile =    xfile.replace('{{DATE}}',str(today))
-        xfile =    xfile.replace('{{EPSG}}',epsg)
-        f.write(xfile)
+    parts = compiled_templates.get(template)
+    if parts is None:
+        parts = compile_sidecar_template(template, keywords)
+        compiled_templates[template] = parts
+    out = parts[:]
+    missing = []
+    for i in range(1, len(out), 2):
+        value = keywords.get(out[i])
+        if value is None:
+            missing.append(out[i])
+        else:
+            out[i] = str(value)
+    if missing:
+        raise ValueError("No value for keyword(s) %s in the sidecar template" %(", ".join("{{%s}}" %(k) for k in sorted(set(missing)))))
+    return "".join(out)
 
 def get_extent_and_srs_of_input_raster(rasras): #UNCHANGED
     """
@@ -108,29 +159,68 @@ def get_extent_and_srs_of_input_raster(rasras): #UNCHANGED
         return ulx, uly, lrx, lry, srs
 
 
-def get_bbox_of_output(ext, srs): #UNCHANGED
-    """
-    The corners of the input raster is transformed to the output system to
-    create a bounding box. The bounding box is returned
-    """
-    source = osr.SpatialReference()
-    source.ImportFromEPSG(int(ext[4]))
-    target = osr.SpatialReference()
-    target.ImportFromEPSG(srs)
-    transform = osr.CoordinateTransformation(source, target)
-    A = []
-    A.append (ogr.CreateGeometryFromWkt("POINT (%s %s)" %(ext[0],ext[3]))) #ll
-    A.append (ogr.CreateGeometryFromWkt("POINT (%s %s)" %(ext[0],ext[1]))) #ul
-    A.append (ogr.CreateGeometryFromWkt("POINT (%s %s)" %(ext[2],ext[1]))) #ur
-    A.append (ogr.CreateGeometryFromWkt("POINT (%s %s)" %(ext[2],ext[3]))) #lr
-    B=[]
-    for p in A:
-        p.Transform(transform)
-        B.append((p.GetX(),p.GetY()))
-    minx = min(B[0][0],B[2][0])
-    maxx = max(B[0][0],B[2][0])
-    miny = min(B[0][1],B[2][1])
-    maxy = max(B[0][1],B[2][1])
+srs_cache = {}       #SpatialReference objects by (epsg, traditional axis order)
+transform_cache = {} #CoordinateTransformation objects by (source epsg, target epsg, traditional axis order)
+
+def get_srs(epsg, traditional=False):
+    """
+    A (cached) SpatialReference for an EPSG code. With traditional=True the traditional
+    GIS axis order is used (x = easting/longitude), otherwise the authority order
+    (e.g. lat/lon for EPSG:4326 in GDAL 3)
+    """
+    key = (int(epsg), traditional)
+    srs = srs_cache.get(key)
+    if srs is None:
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(int(epsg))
+        if traditional and hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'): #GDAL 3 and later
+            srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        srs_cache[key] = srs
+    return srs
+
+def get_transform(src_epsg, dst_epsg, traditional=True):
+    """
+    A (cached) coordinate transformation between two EPSG codes. By default the traditional
+    GIS axis order is used in both ends, i.e. the same order as GetGeoTransform and the
+    gdal.Warp bounds
+    """
+    key = (int(src_epsg), int(dst_epsg), traditional)
+    transform = transform_cache.get(key)
+    if transform is None:
+        transform = osr.CoordinateTransformation(get_srs(src_epsg, traditional), get_srs(dst_epsg, traditional))
+        transform_cache[key] = transform
+    return transform
+
+def transform_bounds(minx, miny, maxx, maxy, src_epsg, dst_epsg, traditional=True, densify=256):
+    """
+    A rectangle is transformed to another srs. The edges are densified (densify points per side)
+    and all points are transformed in one batch, so curved edges in the target srs are
+    accounted for. Points that fail to transform are ignored. Returns minx, miny, maxx, maxy
+    """
+    pts = []
+    for i in range(densify+1):
+        fx = minx + (maxx-minx)*i/densify
+        fy = miny + (maxy-miny)*i/densify
+        pts.append((fx, miny))
+        pts.append((fx, maxy))
+        pts.append((minx, fy))
+        pts.append((maxx, fy))
+    out = get_transform(src_epsg, dst_epsg, traditional).TransformPoints(pts)
+    xs = [p[0] for p in out if math.isfinite(p[0]) and math.isfinite(p[1])]
+    ys = [p[1] for p in out if math.isfinite(p[0]) and math.isfinite(p[1])]
+    if not xs:
+        raise RuntimeError("Unable to transform bounds from EPSG:%s to EPSG:%s" %(src_epsg, dst_epsg))
+    return min(xs), min(ys), max(xs), max(ys)
+
+def get_bbox_of_output(ext, srs):
+    """
+    The outline of the input raster is transformed to the output system to
+    create a bounding box. The bounding box is returned.
+    As the rest of this project the authority axis order is used here (lat/lon for geographic)
+    """
+    minx, miny, maxx, maxy = transform_bounds(min(ext[0],ext[2]), min(ext[1],ext[3]),
+                                              max(ext[0],ext[2]), max(ext[1],ext[3]),
+                                              ext[4], srs, traditional=False)
     return minx, maxx, miny, maxy
 
 def checkos():
@@ -148,6 +238,2233 @@ def checkos():
         print("Running on a windows machine - check to see if AREA_OR_POINT=Point in output (gdalinfo)")
     dp ("*"*20)
 
+#*--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--*
+#Following functions make up the in-process warping engine. The input is opened once
+#per process and kept open, instead of spawning a gdalwarp process for every tile
+
+source_cache = {}
+
+def open_source(fnam):
+    """
+    The input raster is opened once and cached for the rest of the run, so a large
+    source (e.g. a nationwide vrt) is not re-opened and re-parsed for every tile
+    """
+    src = source_cache.get(fnam)
+    if src is None:
+        dp ("Opening input raster %s" %(fnam))
+        src = gdal.Open(fnam)
+        if src is None:
+            raise RuntimeError("Unable to open input raster %s" %(fnam))
+        source_cache[fnam] = src
+    return src
+
+def close_sources(keep=()):
+    """
+    Cached input datasets are released (e.g. at the end of a run), except those named in keep
+    """
+    for fnam in list(source_cache):
+        if fnam not in keep:
+            del source_cache[fnam]
+    batch_cache.clear()
+
+def get_source_epsg(src):
+    """
+    The EPSG code of an opened dataset
+    """
+    return osr.SpatialReference(wkt=src.GetProjection()).GetAttrValue('AUTHORITY',1)
+
+def warp_to_mem(src_fnam, epsg, minx, miny, maxx, maxy, xres, yres):
+    """
+    A single tile is warped in-process using gdal.Warp on the cached input dataset
+    (src_fnam may also be an already opened dataset, e.g. a strip buffer, or a list of datasets
+    warped in order, so the last one wins where they overlap).
+    The result is kept in memory (MEM driver) and the final DGED header (compound srs
+    with EPSG:3855 and AREA_OR_POINT=Point) is applied before anything is written to disk.
+    Options correspond to the former gdalwarp call:
+    -t_srs EPSG:XXXX+3855 -te minx miny maxx maxy -dstnodata -32767 -tr xres yres -r cubic
+    """
+    gdal.SetConfigOption('GTIFF_REPORT_COMPD_CS', 'YES')
+    threads = settings.get('warp_threads', 1)
+    opts = gdal.WarpOptions(format='MEM',
+                            dstSRS='EPSG:%s+3855' %(epsg),
+                            outputBounds=(minx, miny, maxx, maxy),
+                            xRes=xres, yRes=yres,
+                            dstNodata=-32767,
+                            resampleAlg='cubic',
+                            multithread=threads > 1,
+                            warpOptions=['NUM_THREADS=%s' %(threads)],
+                            warpMemoryLimit=settings.get('warp_mem', 64)*1024*1024) #bytes (GDAL reads values below 10000 as MB)
+    dp ("Warping %s (%s %s %s %s)" %("%s sources" %(len(src_fnam)) if isinstance(src_fnam, list) else src_fnam, minx, miny, maxx, maxy))
+    src = src_fnam
+    if isinstance(src_fnam, str):
+        src = open_source(src_fnam)
+    ds = gdal.Warp('', src, options=opts)
+    if ds is None:
+        raise RuntimeError("Warping of %s failed: %s" %(src_fnam, gdal.GetLastErrorMsg()))
+    ds.SetMetadataItem('AREA_OR_POINT', 'Point')
+    return ds
+
+#GeoTIFF creation profiles for the output tiles. All are plain (DGED compliant) GeoTIFF.
+#'lzw' is the original layout (LZW, strips, no predictor). The predictor is chosen from the
+#data type when the tile is written (3 = floating point, 2 = integer)
+CREATION_PROFILES = {
+    'lzw':     {'options': ['COMPRESS=LZW'],                     'predictor': False, 'tiled': False},
+    'lzw_pred':{'options': ['COMPRESS=LZW'],                     'predictor': True,  'tiled': True},
+    'deflate': {'options': ['COMPRESS=DEFLATE', 'ZLEVEL=6'],     'predictor': True,  'tiled': True},
+    'zstd':    {'options': ['COMPRESS=ZSTD', 'ZSTD_LEVEL=9'],    'predictor': True,  'tiled': True},
+    'none':    {'options': ['COMPRESS=NONE'],                    'predictor': False, 'tiled': True},
+}
+
+def get_creation_options(profile, ds, blocksize=256, overviews=None):
+    """
+    The GeoTIFF creation options for writing the in-memory tile ds with a creation profile.
+    If overview factors are given, the overviews are built on ds and copied into the tile
+    """
+    prof = CREATION_PROFILES[profile]
+    opts = list(prof['options'])
+    if prof['predictor']:
+        if gdal.GetDataTypeName(ds.GetRasterBand(1).DataType).startswith('Float'):
+            opts.append('PREDICTOR=3')
+        else:
+            opts.append('PREDICTOR=2')
+    if prof['tiled']:
+        opts = opts + ['TILED=YES', 'BLOCKXSIZE=%s' %(blocksize), 'BLOCKYSIZE=%s' %(blocksize)]
+    if overviews:
+        ds.BuildOverviews('AVERAGE', overviews)
+        opts.append('COPY_SRC_OVERVIEWS=YES')
+    return opts
+
+def write_tile(ds, dst_fnam, creation_options=None):
+    """
+    The in-memory tile is written to disk with a single CreateCopy (header included)
+    """
+    if creation_options is None:
+        creation_options = ['COMPRESS=LZW']
+    dp ("Writing %s" %(dst_fnam))
+    out = gdal.GetDriverByName('GTiff').CreateCopy(dst_fnam, ds, options=creation_options)
+    if out is None:
+        raise RuntimeError("Writing of %s failed: %s" %(dst_fnam, gdal.GetLastErrorMsg()))
+    out = None #flush and close
+
+def fix_header_with_gdal_edit(fnam, epsg):
+    """
+    Fallback only: the tiff header is adjusted afterwards with the bundled gdal_edit.py
+    (the way it was done before the header was written in the warp pass)
+    """
+    cmdstr = """python gdal_edit.py --config GTIFF_REPORT_COMPD_CS YES -a_srs epsg:%s+3855 -mo AREA_OR_POINT=POINT %s""" %(epsg,fnam)
+    dp (cmdstr)
+    run_cmd(cmdstr)
+
+def get_total_memory_mb():
+    """
+    Physical memory of the machine in MB (4096 if it can not be determined)
+    """
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1024*1024)
+    except (ValueError, OSError, AttributeError): #e.g. windows
+        return 4096
+
+def resolve_resources(jobs, warp_threads=0, warp_mem=0, cache_mb=0):
+    """
+    Warp threads, warp working memory (MB) and GDAL block cache (MB) per process. Values of 0 are
+    chosen automatically so that jobs x warp threads does not exceed the number of cores and
+    the processes together use at most half of the physical memory (half of that share for the
+    block cache, a quarter for the warp buffers, the rest is left for strips and output tiles)
+    """
+    jobs = max(1, jobs)
+    if warp_threads <= 0:
+        warp_threads = max(1, (os.cpu_count() or 1) // jobs)
+    budget = get_total_memory_mb() // 2 // jobs
+    if cache_mb <= 0:
+        cache_mb = max(64, budget // 2)
+    if warp_mem <= 0:
+        warp_mem = max(64, budget // 4)
+    return warp_threads, warp_mem, cache_mb
+
+#*--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--*
+#Following functions determine the real footprint of the input (where there is data),
+#so tiles without any source data can be dropped before warping starts
+
+def box_geometry(minx, miny, maxx, maxy):
+    """
+    An ogr polygon for a rectangle
+    """
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    ring.AddPoint_2D(minx, miny)
+    ring.AddPoint_2D(maxx, miny)
+    ring.AddPoint_2D(maxx, maxy)
+    ring.AddPoint_2D(minx, maxy)
+    ring.AddPoint_2D(minx, miny)
+    box = ogr.Geometry(ogr.wkbPolygon)
+    box.AddGeometry(ring)
+    return box
+
+def get_vrt_sources(src):
+    """
+    For a vrt the sources and their extents are read from the vrt xml (no source files are opened).
+    Returns a list of (filename, (minx, miny, maxx, maxy)) in the coordinates of the input or None
+    if the input is not a vrt
+    """
+    if src.GetDriver().ShortName != 'VRT':
+        return None
+    vrtxml = src.GetMetadata('xml:VRT')
+    if not vrtxml:
+        return None
+    vrtdir = os.path.dirname(src.GetDescription())
+    ulx, xres, xskew, uly, yskew, yres = src.GetGeoTransform()
+    sources = []
+    for band in ET.fromstring(vrtxml[0]).iter('VRTRasterBand'):
+        for source in band:
+            dstrect = source.find('DstRect')
+            srcfnam = source.find('SourceFilename')
+            if dstrect is None or srcfnam is None:
+                continue
+            fnam = srcfnam.text
+            if srcfnam.get('relativeToVRT') == '1':
+                fnam = os.path.join(vrtdir, fnam)
+            xoff = float(dstrect.get('xOff'))
+            yoff = float(dstrect.get('yOff'))
+            x0 = ulx + xoff*xres
+            x1 = ulx + (xoff + float(dstrect.get('xSize')))*xres
+            y0 = uly + yoff*yres
+            y1 = uly + (yoff + float(dstrect.get('ySize')))*yres
+            sources.append((fnam, (min(x0,x1), min(y0,y1), max(x0,x1), max(y0,y1))))
+        break #the first band is sufficient
+    return sources
+
+def get_mask_polygons(src, size=512):
+    """
+    The mask of the input is read at low resolution (overviews are used if present) and
+    polygonized. A low resolution cell is valid if any of the pixels it covers are valid.
+    Returns the footprint in the coordinates of the input and the low resolution cell size
+    """
+    xsize = min(size, src.RasterXSize)
+    ysize = min(size, src.RasterYSize)
+    small = gdal.Translate('', src, format='MEM', width=xsize, height=ysize, resampleAlg='average', bandList=[1])
+    ulx, xres, xskew, uly, yskew, yres = small.GetGeoTransform()
+    mask = small.GetRasterBand(1).GetMaskBand()
+    vdrv = ogr.GetDriverByName('Memory') or ogr.GetDriverByName('MEM')
+    vds = vdrv.CreateDataSource('footprint')
+    layer = vds.CreateLayer('footprint', geom_type=ogr.wkbPolygon)
+    gdal.Polygonize(mask, mask, layer, -1, [])
+    footprint = ogr.Geometry(ogr.wkbMultiPolygon)
+    for feat in layer:
+        footprint.AddGeometry(feat.GetGeometryRef())
+    if footprint.IsEmpty(): #no valid data at all
+        return footprint, max(abs(xres), abs(yres))
+    return footprint.UnionCascaded(), max(abs(xres), abs(yres))
+
+def get_footprint_of_input_raster(rasras, out_epsg):
+    """
+    The valid-data footprint of the input is determined and transformed to the output srs.
+    For a vrt the union of the source extents is used, otherwise the low resolution mask.
+    The footprint is grown by one low resolution cell (and the edges densified before
+    transforming) so tiles are only dropped if they are safely outside the data.
+    """
+    src = open_source(rasras)
+    in_epsg = get_source_epsg(src)
+    sources = get_vrt_sources(src)
+    if sources:
+        dp ("Footprint is determined from %s vrt sources" %(len(sources)))
+        footprint = ogr.Geometry(ogr.wkbMultiPolygon)
+        for fnam, r in sources:
+            footprint.AddGeometry(box_geometry(*r))
+        footprint = footprint.UnionCascaded()
+        ulx, xres, xskew, uly, yskew, yres = src.GetGeoTransform()
+        cell = max(abs(xres), abs(yres))
+    else:
+        dp ("Footprint is determined from the mask of the input")
+        footprint, cell = get_mask_polygons(src)
+    footprint = footprint.Buffer(cell)
+    minx, maxx, miny, maxy = footprint.GetEnvelope()
+    footprint.Segmentize(max(maxx-minx, maxy-miny)/100.0) #the edges may curve in the output srs
+    footprint.Transform(get_transform(in_epsg, out_epsg))
+    return footprint
+
+def prune_tiles(tiles, footprint):
+    """
+    Tiles that do not intersect the footprint are removed from the plan.
+    Returns the remaining tiles and the number of tiles pruned
+    """
+    keep = []
+    for tile in tiles:
+        if footprint.Intersects(box_geometry(*tile['bounds'])):
+            keep.append(tile)
+    return keep, len(tiles)-len(keep)
+
+PLAN_FIELDS = ['basename', 'level', 'epsg', 'row', 'minx', 'miny', 'maxx', 'maxy', 'xres', 'yres']
+
+def plan_records(level_tiles):
+    """
+    The planned tiles of all levels as flat records (dicts with the PLAN_FIELDS)
+    """
+    for level, tiles in level_tiles:
+        for tile in tiles:
+            minx, miny, maxx, maxy = tile['bounds']
+            yield {'basename': tile['basename'], 'level': tile['level'], 'epsg': tile['epsg'], 'row': tile['row'],
+                   'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy, 'xres': tile['xres'], 'yres': tile['yres']}
+
+def write_plan(level_tiles, fnam):
+    """
+    The complete tile plan is written to fnam. The format follows the extension: .csv, .json or
+    .gpkg (a polygon layer per srs, named tiles_<epsg>). Returns the number of tiles written
+    """
+    ext = os.path.splitext(fnam)[1].lower()
+    count = 0
+    if ext == '.csv':
+        with open(fnam, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=PLAN_FIELDS)
+            writer.writeheader()
+            for record in plan_records(level_tiles):
+                writer.writerow(record)
+                count = count +1
+    elif ext == '.json':
+        records = list(plan_records(level_tiles))
+        with open(fnam, 'w') as f:
+            json.dump(records, f)
+        count = len(records)
+    elif ext == '.gpkg':
+        drv = ogr.GetDriverByName('GPKG')
+        if os.path.exists(fnam):
+            drv.DeleteDataSource(fnam)
+        ds = drv.CreateDataSource(fnam)
+        layers = {}
+        ds.StartTransaction()
+        for record in plan_records(level_tiles):
+            layer = layers.get(record['epsg'])
+            if layer is None:
+                layer = ds.CreateLayer("tiles_%s" %(record['epsg']), get_srs(record['epsg'], traditional=True), ogr.wkbPolygon)
+                for name in PLAN_FIELDS:
+                    ftype = ogr.OFTReal
+                    if name in ('basename', 'level'):
+                        ftype = ogr.OFTString
+                    elif name in ('epsg', 'row'):
+                        ftype = ogr.OFTInteger
+                    layer.CreateField(ogr.FieldDefn(name, ftype))
+                layers[record['epsg']] = layer
+            feature = ogr.Feature(layer.GetLayerDefn())
+            for name in PLAN_FIELDS:
+                feature.SetField(name, record[name])
+            feature.SetGeometry(box_geometry(record['minx'], record['miny'], record['maxx'], record['maxy']))
+            layer.CreateFeature(feature)
+            count = count +1
+        ds.CommitTransaction()
+        ds = None
+    else:
+        raise ValueError("Unknown plan format %s (use .csv, .json or .gpkg)" %(fnam))
+    return count
+
+#*--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--*
+#Following functions implement batch input: several rasters (a list, a directory or a glob) are
+#converted into one tile grid. An in-memory grid index of the source extents gives each tile
+#the sources intersecting it (including the halo of the cubic kernel), which are warped in one
+#gdal.Warp. Where sources overlap, the later source in the precedence order wins
+
+INPUT_PATTERNS = ['*.tif', '*.tiff', '*.img', '*.vrt']
+INPUTS_VRT = "/vsimem/dem2dged_inputs.vrt" #the inputs as one dataset for planning and metadata
+source_index = {} #grid index of the input sources of the run (see select_sources)
+BATCH_SOURCES_OPEN = 64 #batch sources kept open per process, the least recently used is closed
+batch_cache = collections.OrderedDict() #opened batch sources by file name, least recently used first
+
+def open_batch_source(fnam):
+    """
+    A batch source is opened, or taken from the cache of recently used sources. Unlike the input
+    raster (see open_source) only a few are kept open, so a batch of thousands of files does not
+    run out of file handles
+    """
+    src = batch_cache.pop(fnam, None)
+    if src is None:
+        dp ("Opening input raster %s" %(fnam))
+        src = gdal.Open(fnam)
+        if src is None:
+            raise RuntimeError("Unable to open input raster %s" %(fnam))
+        while len(batch_cache) >= BATCH_SOURCES_OPEN:
+            batch_cache.popitem(last=False)
+    batch_cache[fnam] = src
+    return src
+
+def resolve_inputs(spec):
+    """
+    The input rasters of an input argument: a raster, a comma separated list, a directory (all rasters
+    in it), a glob pattern or a text file (.txt) with one raster per line. Returns a list of file names
+    """
+    if os.path.isdir(spec):
+        files = []
+        for pattern in INPUT_PATTERNS:
+            files = files + glob.glob(os.path.join(spec, pattern))
+        return sorted(files)
+    if spec.lower().endswith('.txt') and os.path.isfile(spec):
+        with open(spec) as f:
+            return [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    if ',' in spec:
+        return [fnam for fnam in spec.split(',') if fnam]
+    if any(c in spec for c in '*?[') and not os.path.exists(spec):
+        return sorted(glob.glob(spec))
+    return [spec]
+
+def prepare_inputs(spec, precedence='order'):
+    """
+    The inputs are resolved and, if there are several, ordered by precedence (the last wins where
+    sources overlap): 'order' as given, 'newest' by modification time or 'finest' by resolution.
+    Returns the input raster to plan from (the single input or a vrt of all inputs in memory) and the
+    list of sources (dicts with path, extent, resolution and epsg, None for a single input)
+    """
+    files = resolve_inputs(spec)
+    if not files:
+        raise RuntimeError("No input rasters found for %s" %(spec))
+    if len(files) == 1:
+        return files[0], None
+    sources = []
+    epsg = None
+    for fnam in files:
+        src = gdal.Open(fnam)
+        if src is None:
+            raise RuntimeError("Unable to open input raster %s" %(fnam))
+        if epsg is None:
+            epsg = get_source_epsg(src)
+        elif get_source_epsg(src) != epsg:
+            raise RuntimeError("%s is not in the srs of the other inputs (EPSG:%s)" %(fnam, epsg))
+        ulx, xres, xskew, uly, yskew, yres = src.GetGeoTransform()
+        lrx = ulx + src.RasterXSize*xres
+        lry = uly + src.RasterYSize*yres
+        sources.append({'path': fnam, 'extent': (min(ulx,lrx), min(uly,lry), max(ulx,lrx), max(uly,lry)),
+                        'res': max(abs(xres), abs(yres)), 'mtime': os.path.getmtime(fnam), 'epsg': int(epsg)})
+        src = None
+    if precedence == 'newest':
+        sources.sort(key=lambda source: source['mtime'])
+    elif precedence == 'finest':
+        sources.sort(key=lambda source: -source['res'])
+    dp ("%s input rasters (EPSG:%s), %s precedence" %(len(sources), epsg, precedence))
+    vrt = gdal.BuildVRT(INPUTS_VRT, [source['path'] for source in sources], options=gdal.BuildVRTOptions(resolution='highest'))
+    if vrt is None:
+        raise RuntimeError("Unable to combine the inputs: %s" %(gdal.GetLastErrorMsg()))
+    vrt = None #flush and close
+    return INPUTS_VRT, sources
+
+def build_source_index(sources):
+    """
+    A grid index of the source extents. The cell size is the median source size, so most
+    sources fall in a few cells. Returns (cell size, dict of cell: list of source positions)
+    """
+    sizes = sorted(max(s['extent'][2]-s['extent'][0], s['extent'][3]-s['extent'][1]) for s in sources)
+    cell = max(sizes[len(sizes)//2], 1e-9)
+    cells = {}
+    for i, source in enumerate(sources):
+        minx, miny, maxx, maxy = source['extent']
+        for ix in range(int(math.floor(minx/cell)), int(math.floor(maxx/cell))+1):
+            for iy in range(int(math.floor(miny/cell)), int(math.floor(maxy/cell))+1):
+                cells.setdefault((ix, iy), []).append(i)
+    return cell, cells
+
+def select_sources(tile):
+    """
+    The input sources intersecting a tile, grown by the halo of the cubic kernel, in precedence order.
+    Returns a list of opened datasets (empty if no source touches the tile)
+    """
+    sources = settings['input_sources']
+    if source_index.get('sources') is not sources: #built once per run and process
+        source_index['sources'] = sources
+        source_index['index'] = build_source_index(sources)
+    cell, cells = source_index['index']
+    minx, miny, maxx, maxy = tile['bounds']
+    bx0, by0, bx1, by1 = transform_bounds(minx, miny, maxx, maxy, tile['epsg'], sources[0]['epsg'], densify=16)
+    posts = max(1, int(round((maxx-minx)/tile['xres'])))
+    halo = 2*max((bx1-bx0)/posts, max(s['res'] for s in sources)) #cubic kernel in the coarser of output and source
+    bx0, by0, bx1, by1 = bx0-halo, by0-halo, bx1+halo, by1+halo
+    found = set()
+    for ix in range(int(math.floor(bx0/cell)), int(math.floor(bx1/cell))+1):
+        for iy in range(int(math.floor(by0/cell)), int(math.floor(by1/cell))+1):
+            found.update(cells.get((ix, iy), ()))
+    selected = []
+    for i in sorted(found): #the precedence order
+        ex0, ey0, ex1, ey1 = sources[i]['extent']
+        if ex0 < bx1 and ex1 > bx0 and ey0 < by1 and ey1 > by0:
+            selected.append(open_batch_source(sources[i]['path']))
+    return selected
+
+#*--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--*
+#Following functions handle the run manifest: a sqlite database in the output folder
+#recording every planned tile, its state (planned, warping, done, failed), timings, size
+#and checksum. It is used for resuming runs and for status/retry (dem2dged_manifest.py)
+
+MANIFEST_NAME = "dem2dged_manifest.sqlite"
+manifest_lock = threading.Lock() #the pool feeds tasks from a separate thread
+
+TILE_STAT_COLUMNS = ['min_elev', 'max_elev', 'mean_elev', 'void_pct'] #elevation statistics of the tiles done
+
+def open_manifest(output_folder, name=MANIFEST_NAME):
+    """
+    The manifest of the output folder is opened (and created if it does not exist)
+    """
+    conn = sqlite3.connect(os.path.join(output_folder, name), timeout=60, check_same_thread=False)
+    conn.execute("""CREATE TABLE IF NOT EXISTS tiles (basename TEXT PRIMARY KEY, level TEXT, epsg INTEGER, row INTEGER,
+                    minx REAL, miny REAL, maxx REAL, maxy REAL, xres REAL, yres REAL, gsd REAL,
+                    state TEXT, started REAL, finished REAL, seconds REAL, bytes INTEGER, checksum TEXT, error TEXT)""")
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(tiles)")]
+    if 'row' not in columns: #manifests from before strip buffering (tile row in the grid)
+        conn.execute("ALTER TABLE tiles ADD COLUMN row INTEGER")
+    for name in TILE_STAT_COLUMNS: #manifests from before the statistics were recorded
+        if name not in columns:
+            conn.execute("ALTER TABLE tiles ADD COLUMN %s REAL" %(name))
+    if 'volume' not in columns: #archive volume holding the tile (see archive output)
+        conn.execute("ALTER TABLE tiles ADD COLUMN volume TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS tiles_state ON tiles (state)")
+    conn.execute("CREATE TABLE IF NOT EXISTS run (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("""CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime REAL, size INTEGER,
+                    minx REAL, miny REAL, maxx REAL, maxy REAL)""")
+    conn.execute("CREATE TABLE IF NOT EXISTS qa (basename TEXT PRIMARY KEY, checksum TEXT, ok INTEGER, checked REAL, problems TEXT)")
+    conn.execute("CREATE TABLE IF NOT EXISTS volumes (name TEXT PRIMARY KEY, data_end INTEGER, checkpoint REAL)")
+    conn.commit()
+    return conn
+
+def manifest_add_tiles(conn, tiles):
+    """
+    Planned tiles are added to the manifest (in one transaction). Tiles already known keep their state.
+    """
+    with manifest_lock, conn:
+        conn.executemany("""INSERT OR IGNORE INTO tiles (basename, level, epsg, row, minx, miny, maxx, maxy, xres, yres, gsd, state)
+                            VALUES (?,?,?,?,?,?,?,?,?,?,?,'planned')""",
+                         [(t['basename'], t['level'], t['epsg'], t['row'], t['bounds'][0], t['bounds'][1], t['bounds'][2], t['bounds'][3],
+                           t['xres'], t['yres'], t['gsd']) for t in tiles])
+
+def manifest_set_state(conn, basename, state, **fields):
+    """
+    The state (and optionally other columns) of a tile is updated atomically
+    """
+    cols = ["state=?"] + ["%s=?" %(k) for k in fields]
+    with manifest_lock, conn:
+        conn.execute("UPDATE tiles SET %s WHERE basename=?" %(", ".join(cols)), [state] + list(fields.values()) + [basename])
+
+def manifest_get_tiles(conn, state=None):
+    """
+    Returns the tiles (dicts, as planned) of the manifest - all or only those in a given state
+    """
+    sql = "SELECT basename, level, epsg, row, minx, miny, maxx, maxy, xres, yres, gsd FROM tiles"
+    if state is None:
+        rows = conn.execute(sql).fetchall()
+    else:
+        rows = conn.execute(sql + " WHERE state=?", (state,)).fetchall()
+    return [{'basename': r[0], 'level': r[1], 'epsg': r[2], 'row': r[3], 'bounds': (r[4], r[5], r[6], r[7]),
+             'xres': r[8], 'yres': r[9], 'gsd': r[10]} for r in rows]
+
+def manifest_get_basenames(conn, state):
+    """
+    Returns the set of tile basenames in a given state
+    """
+    return set(r[0] for r in conn.execute("SELECT basename FROM tiles WHERE state=?", (state,)))
+
+def manifest_get_epsgs(conn):
+    """
+    Returns the set of EPSG codes of the planned tile grid (empty for a new manifest)
+    """
+    return set(r[0] for r in conn.execute("SELECT DISTINCT epsg FROM tiles"))
+
+def manifest_set_states(conn, basenames, state):
+    """
+    The state of several tiles is updated in one transaction
+    """
+    with manifest_lock, conn:
+        conn.executemany("UPDATE tiles SET state=? WHERE basename=?", [(state, b) for b in basenames])
+
+def manifest_reset_tiles(conn, basenames):
+    """
+    Tiles are set back to planned, so they are produced again by the next run
+    """
+    manifest_set_states(conn, basenames, 'planned')
+
+def manifest_get_checksums(conn):
+    """
+    Returns the checksums of the tiles done (basename: checksum)
+    """
+    return dict(conn.execute("SELECT basename, checksum FROM tiles WHERE state='done'").fetchall())
+
+def manifest_get_validated(conn):
+    """
+    Returns the checksums of the tiles that passed validation (basename: checksum)
+    """
+    return dict(conn.execute("SELECT basename, checksum FROM qa WHERE ok=1").fetchall())
+
+def manifest_store_validation(conn, results):
+    """
+    Validation results (see validate_tile) are stored, so the next validation can skip unchanged tiles
+    """
+    with manifest_lock, conn:
+        conn.executemany("INSERT OR REPLACE INTO qa (basename, checksum, ok, checked, problems) VALUES (?, ?, ?, ?, ?)",
+                         [(r['basename'], r['checksum'], int(not r['problems']), time.time(), json.dumps(r['problems'])) for r in results])
+
+def manifest_store_sources(conn, sources):
+    """
+    The input sources (path, mtime, size and extent) of a successful run are recorded
+    """
+    with manifest_lock, conn:
+        conn.execute("DELETE FROM sources")
+        conn.executemany("INSERT INTO sources (path, mtime, size, minx, miny, maxx, maxy) VALUES (?,?,?,?,?,?,?)",
+                         [(s['path'], s['mtime'], s['size']) + tuple(s['extent']) for s in sources])
+
+def manifest_load_sources(conn):
+    """
+    Returns the input sources recorded by the last successful run, by path
+    """
+    rows = conn.execute("SELECT path, mtime, size, minx, miny, maxx, maxy FROM sources").fetchall()
+    return dict((r[0], {'path': r[0], 'mtime': r[1], 'size': r[2], 'extent': (r[3], r[4], r[5], r[6])}) for r in rows)
+
+def manifest_store_volume(conn, name, data_end, results):
+    """
+    A checkpoint of an archive volume (see archive_checkpoint) is recorded in one transaction
+    together with the results of the tiles added to the volume since the last checkpoint
+    """
+    with manifest_lock, conn:
+        conn.execute("INSERT OR REPLACE INTO volumes (name, data_end, checkpoint) VALUES (?, ?, ?)",
+                     (name, data_end, time.time()))
+        for result in results:
+            fields = dict((k, v) for k, v in result.items() if k not in ('basename', 'state', 'timings'))
+            cols = ["state=?"] + ["%s=?" %(k) for k in fields]
+            conn.execute("UPDATE tiles SET %s WHERE basename=?" %(", ".join(cols)), [result['state']] + list(fields.values()) + [result['basename']])
+
+def manifest_store_settings(conn, run_settings, level):
+    """
+    The run settings of a level are stored so failed tiles can be retried without the original command line
+    """
+    with manifest_lock, conn:
+        conn.execute("INSERT OR REPLACE INTO run (key, value) VALUES (?, ?)", ('settings_%s' %(level), json.dumps(run_settings)))
+
+def manifest_load_settings(conn, level):
+    """
+    Returns the run settings stored for a level by the last run (or None)
+    """
+    row = conn.execute("SELECT value FROM run WHERE key=?", ('settings_%s' %(level),)).fetchone()
+    if row is None:
+        return None
+    return json.loads(row[0])
+
+def manifest_name(run_settings):
+    """
+    The name of the manifest of a run. In distributed mode each node keeps its own manifest
+    (sqlite is not safe for writers on several hosts), the shared state is the work queue
+    """
+    if run_settings.get('distributed'):
+        return "dem2dged_manifest_%s.sqlite" %(run_settings['node_id'])
+    if run_settings.get('archive'): #next to the archive, named after it
+        return os.path.splitext(os.path.basename(run_settings['archive']))[0] + "_manifest.sqlite"
+    return MANIFEST_NAME
+
+def file_checksum(fnam):
+    """
+    sha256 of a file
+    """
+    h = hashlib.sha256()
+    with open(fnam, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+#*--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--*
+#Following functions implement strip buffered reading: the source rows covering a whole
+#row of output tiles are read once into a numpy buffer and every tile of the row is warped
+#from that buffer, so neighbouring tiles do not re-read (and re-decompress) the same blocks
+
+def get_source_window(src, bounds, epsg, out_pixels):
+    """
+    The pixel window (xoff, yoff, xsize, ysize) of the source covering the output bounds
+    (minx, miny, maxx, maxy in EPSG:epsg) including a halo for the cubic kernel.
+    When the output is coarser than the source the kernel grows accordingly.
+    Returns None if the window does not overlap the source
+    """
+    ulx, xres, xskew, uly, yskew, yres = src.GetGeoTransform()
+    minx, miny, maxx, maxy = transform_bounds(bounds[0], bounds[1], bounds[2], bounds[3], epsg, get_source_epsg(src))
+    x0 = (minx-ulx)/xres
+    x1 = (maxx-ulx)/xres
+    y0 = (maxy-uly)/yres
+    y1 = (miny-uly)/yres
+    src_px_per_out_px = max(1.0, abs(x1-x0)/max(1, out_pixels))
+    halo = 2*int(math.ceil(src_px_per_out_px)) + 2
+    xoff = max(0, int(math.floor(min(x0,x1))) - halo)
+    yoff = max(0, int(math.floor(min(y0,y1))) - halo)
+    xend = min(src.RasterXSize, int(math.ceil(max(x0,x1))) + halo)
+    yend = min(src.RasterYSize, int(math.ceil(max(y0,y1))) + halo)
+    if xend <= xoff or yend <= yoff:
+        return None
+    return xoff, yoff, xend-xoff, yend-yoff
+
+def read_strip(src, window):
+    """
+    The window of the source (first band) is read into a numpy array and wrapped in a
+    georeferenced in-memory dataset that can be warped like the source itself
+    """
+    xoff, yoff, xsize, ysize = window
+    band = src.GetRasterBand(1)
+    arr = band.ReadAsArray(xoff, yoff, xsize, ysize)
+    ulx, xres, xskew, uly, yskew, yres = src.GetGeoTransform()
+    strip = gdal.GetDriverByName('MEM').Create('', xsize, ysize, 1, band.DataType)
+    strip.SetGeoTransform((ulx + xoff*xres + yoff*xskew, xres, xskew, uly + xoff*yskew + yoff*yres, yskew, yres))
+    strip.SetProjection(src.GetProjection())
+    sband = strip.GetRasterBand(1)
+    nodata = band.GetNoDataValue()
+    if nodata is not None:
+        sband.SetNoDataValue(nodata)
+    sband.WriteArray(arr)
+    return strip
+
+def render_row(tiles):
+    """
+    A row of tiles is produced from one strip of the source. If the strip would exceed the
+    memory bound (settings['strip_mb']) the tiles read from the source directly.
+    Returns a list of results (see render_tile)
+    """
+    if settings.get('input_sources') and tile_source(tiles[0]) == settings['input_raster']:
+        return render_tiles(tiles) #batch input, every tile reads its own sources
+    src = open_source(tile_source(tiles[0])) #a row holds tiles of one srs
+    minx = min(t['bounds'][0] for t in tiles)
+    miny = min(t['bounds'][1] for t in tiles)
+    maxx = max(t['bounds'][2] for t in tiles)
+    maxy = max(t['bounds'][3] for t in tiles)
+    out_pixels = int(round((maxx-minx)/tiles[0]['xres']))
+    window = get_source_window(src, (minx, miny, maxx, maxy), tiles[0]['epsg'], out_pixels)
+    strip = None
+    if window is not None:
+        nbytes = window[2]*window[3]*gdal.GetDataTypeSize(src.GetRasterBand(1).DataType)//8
+        if nbytes <= settings['strip_mb']*1024*1024:
+            dp ("Reading strip %s (%s MB) for %s tiles" %(window, nbytes//(1024*1024), len(tiles)))
+            strip = read_strip(src, window)
+        else:
+            dp ("Strip of %s MB exceeds the memory bound, reading tiles directly" %(nbytes//(1024*1024)))
+    results = render_tiles(tiles, strip)
+    strip = None
+    return results
+
+def group_tiles_by_row(tiles):
+    """
+    Tiles are grouped by row (and srs) in the order they appear
+    """
+    rows = {}
+    for tile in tiles:
+        rows.setdefault((tile['epsg'], tile['level'], tile['row']), []).append(tile)
+    return list(rows.values())
+
+#*--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--*
+#Following functions implement the distributed mode: several nodes (hosts or processes)
+#share one output folder and coordinate through a work queue directory in it only.
+#Every tile is claimed by atomically creating a claim file named after it. Claims are kept alive by a
+#heartbeat (touching the file) and claims not touched within the lease are reclaimed.
+#A finished tile gets a done marker in the queue directory.
+
+QUEUE_DIR = ".dem2dged_queue"
+held_claims = set()
+claims_lock = threading.Lock()
+heartbeat_thread = None
+
+def default_node_id():
+    """
+    Host name and process id, unique for every node taking part in a distributed run
+    """
+    return "%s_%s" %(socket.gethostname(), os.getpid())
+
+def queue_path(name):
+    """
+    Path of a file in the work queue directory of the output folder
+    """
+    return os.path.join(settings['output_folder'], QUEUE_DIR, name)
+
+def heartbeat():
+    """
+    The claims held by this process are touched regularly, so other nodes know they are alive
+    """
+    while True:
+        time.sleep(max(1, settings['lease_sec']/4))
+        with claims_lock:
+            for fnam in list(held_claims):
+                try:
+                    os.utime(fnam, None)
+                except OSError:
+                    held_claims.discard(fnam)
+
+def start_heartbeat():
+    """
+    The heartbeat thread is started once per process
+    """
+    global heartbeat_thread
+    if heartbeat_thread is None:
+        heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+        heartbeat_thread.start()
+
+def try_claim(key):
+    """
+    A unit of work is claimed by creating its claim file exclusively. An existing claim is only
+    taken over when it has not been touched within the lease (its node is considered dead).
+    Taking over is guarded by a reclaim file, so only one node reclaims, and the age is checked
+    again under the guard. Returns True if claimed
+    """
+    fnam = queue_path(key+'.claim')
+    try:
+        fd = os.open(fnam, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            age = time.time() - os.path.getmtime(fnam)
+        except OSError: #released in the meantime - try again in the next pass
+            return False
+        if age < settings['lease_sec']:
+            return False
+        guard = fnam+'.reclaim'
+        try:
+            gfd = os.open(guard, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(guard) > settings['lease_sec']:
+                    os.remove(guard) #left by a node that died while reclaiming
+            except OSError:
+                pass
+            return False
+        os.close(gfd)
+        try:
+            #another node may have reclaimed it between the first look and the guard
+            age = time.time() - os.path.getmtime(fnam)
+            if age < settings['lease_sec']:
+                return False
+            print("Reclaiming stale claim %s (%i s old)" %(key, age))
+            os.remove(fnam)
+            fd = os.open(fnam, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except OSError:
+            return False
+        finally:
+            os.remove(guard)
+    os.write(fd, ("%s %s" %(settings['node_id'], time.time())).encode())
+    os.close(fd)
+    with claims_lock:
+        held_claims.add(fnam)
+    return True
+
+def release_claim(key):
+    """
+    A claim is removed when the unit of work is finished (or failed)
+    """
+    fnam = queue_path(key+'.claim')
+    with claims_lock:
+        held_claims.discard(fnam)
+    try:
+        os.remove(fnam)
+    except OSError:
+        pass
+
+def is_done_in_queue(tile):
+    """
+    True if any node has finished the tile
+    """
+    return os.path.exists(queue_path(tile['basename']+'.done'))
+
+def render_claimed(tiles):
+    """
+    Distributed worker: the tiles of the unit (a tile, a chunk or a row of tiles) are claimed one
+    by one under their basename, which is the same on every node however the nodes group their
+    units, and only the tiles claimed are produced. Tiles finished by other nodes are reported with
+    the state 'remote', tiles claimed by a live node as 'busy' (to be checked again later)
+    """
+    results = [{'basename': tile['basename'], 'state': 'remote'} for tile in tiles if is_done_in_queue(tile)]
+    claimed = []
+    for tile in tiles:
+        if is_done_in_queue(tile):
+            continue
+        if try_claim(tile['basename']):
+            claimed.append(tile)
+        else:
+            results.append({'basename': tile['basename'], 'state': 'busy'})
+    if not claimed:
+        return results
+    try:
+        todo = [tile for tile in claimed if not is_done_in_queue(tile)] #may have been finished just before the claim
+        results = results + [{'basename': tile['basename'], 'state': 'remote'} for tile in claimed if tile not in todo]
+        if settings.get('strip_mb', 0) > 0:
+            produced = render_row(todo) if todo else []
+        else:
+            produced = render_tiles(todo) if todo else []
+        for result in produced:
+            if result['state'] == 'done':
+                with open(queue_path(result['basename']+'.done'), 'w') as f:
+                    f.write(settings['node_id'])
+        return results + produced
+    finally:
+        for tile in claimed:
+            release_claim(tile['basename'])
+
+#*--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--*
+#Following functions stream the output into an archive (.zip or .tar) instead of a folder.
+#The workers write each tile to a /vsimem/ buffer and return its bytes, the main process is the
+#only writer of the archive. The manifest and the run files are kept in the folder of the archive.
+#The archive is checkpointed regularly (the volume is flushed, the offset after its last entry is
+#recorded and the tiles added since count as done). The volume stays open, its index is written when
+#it is closed. A run interrupted between checkpoints resumes from the last checkpoint, the index is
+#then rebuilt from the entries (see repair_volume)
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar')
+ARCHIVE_CHECKPOINT_TILES = 500 #tiles added before the archive is checkpointed
+ARCHIVE_CHECKPOINT_SEC = 60 #or seconds since the last checkpoint
+
+def split_output(output):
+    """
+    Returns the output folder and the archive (None if the output is a folder)
+    """
+    if os.path.splitext(output)[1].lower() in ARCHIVE_EXTENSIONS:
+        archive = os.path.abspath(output)
+        return os.path.dirname(archive), archive
+    return output, None
+
+def volume_name(archive, volume_mb, number):
+    """
+    The name of a volume of an archive. Split into volumes the archive name gets a running
+    number (product_001.zip, product_002.zip and so on), otherwise the archive is the only volume
+    """
+    if volume_mb <= 0:
+        return archive
+    stem, ext = os.path.splitext(archive)
+    return "%s_%03d%s" %(stem, number, ext)
+
+def archive_volumes(archive, volume_mb):
+    """
+    Returns the existing volumes of an archive in order
+    """
+    if volume_mb <= 0:
+        return [archive] if os.path.isfile(archive) else []
+    stem, ext = os.path.splitext(archive)
+    pattern = re.compile(re.escape(os.path.basename(stem)) + r"_(\d{3,})" + re.escape(ext) + "$")
+    numbered = []
+    for fnam in glob.glob(glob.escape(stem) + "_*" + ext):
+        m = pattern.match(os.path.basename(fnam))
+        if m:
+            numbered.append((int(m.group(1)), fnam))
+    return [fnam for number, fnam in sorted(numbered)]
+
+def open_volume(fnam, mode):
+    """
+    A volume is opened with zipfile or tarfile (uncompressed, so it can be appended to)
+    """
+    if fnam.lower().endswith('.zip'):
+        return zipfile.ZipFile(fnam, mode, allowZip64=True)
+    return tarfile.open(fnam, mode)
+
+def volume_data_end(handle):
+    """
+    The offset in an open volume after the last entry, where its index (zip) or end marker (tar) starts
+    """
+    if isinstance(handle, zipfile.ZipFile):
+        return handle.start_dir
+    return handle.offset
+
+def add_to_volume(handle, name, data, compress=False):
+    """
+    An entry is added to an open volume. Tiles are stored as they are (they are compressed already)
+    """
+    if isinstance(handle, zipfile.ZipFile):
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        info.external_attr = 0o644 << 16
+        handle.writestr(info, data)
+    else:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        info.mode = 0o644
+        handle.addfile(info, io.BytesIO(data))
+
+def volume_is_closed(fnam, data_end):
+    """
+    True if the volume ends with a complete index (zip) or end marker (tar) right after data_end
+    """
+    try:
+        if fnam.lower().endswith('.zip'):
+            with zipfile.ZipFile(fnam, 'r') as handle:
+                return handle.start_dir == data_end
+        with open(fnam, 'rb') as f:
+            f.seek(data_end)
+            tail = f.read(tarfile.RECORDSIZE+1)
+        return len(tail) >= 2*tarfile.BLOCKSIZE and tail.count(tarfile.NUL) == len(tail)
+    except (zipfile.BadZipFile, OSError):
+        return False
+
+def zip_entries(f, data_end):
+    """
+    The entries of a zip volume up to data_end, read from their local headers (for a volume without
+    a valid central directory). Returns a list of ZipInfo with their offsets
+    """
+    infos = []
+    offset = 0
+    while offset < data_end:
+        f.seek(offset)
+        header = struct.unpack(zipfile.structFileHeader, f.read(zipfile.sizeFileHeader))
+        if header[0] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile("No entry at offset %s" %(offset))
+        flag_bits, compress_type, dostime, dosdate, crc, compress_size, file_size, name_len, extra_len = header[3:]
+        name = f.read(name_len).decode('utf-8' if flag_bits & 0x800 else 'cp437')
+        extra = f.read(extra_len)
+        pos = 0
+        while pos + 4 <= len(extra): #zip64 sizes
+            tag, size = struct.unpack('<HH', extra[pos:pos+4])
+            if tag == 1:
+                values = list(struct.unpack('<%sQ' %(size//8), extra[pos+4:pos+4+size//8*8]))
+                if file_size == 0xFFFFFFFF and values:
+                    file_size = values.pop(0)
+                if compress_size == 0xFFFFFFFF and values:
+                    compress_size = values.pop(0)
+            pos = pos + 4 + size
+        info = zipfile.ZipInfo(name, ((dosdate>>9)+1980, (dosdate>>5)&0xF, dosdate&0x1F, dostime>>11, (dostime>>5)&0x3F, (dostime&0x1F)*2))
+        info.flag_bits = flag_bits
+        info.compress_type = compress_type
+        info.CRC = crc
+        info.compress_size = compress_size
+        info.file_size = file_size
+        info.header_offset = offset
+        info.external_attr = 0o644 << 16
+        infos.append(info)
+        offset = offset + zipfile.sizeFileHeader + name_len + extra_len + compress_size
+    return infos
+
+def repair_volume(fnam, conn):
+    """
+    A volume left open by an interrupted run is reset to its last checkpoint: the entries added
+    after it are cut off and the index (zip central directory, rebuilt from the entries) or the
+    end marker (tar) is written. A volume unknown to the manifest is only checked.
+    Returns False if the volume can not be used
+    """
+    row = conn.execute("SELECT data_end FROM volumes WHERE name=?", (os.path.basename(fnam),)).fetchone()
+    if row is None:
+        try:
+            open_volume(fnam, 'r').close()
+            return True
+        except (zipfile.BadZipFile, tarfile.TarError, EOFError):
+            return False
+    data_end = row[0]
+    if os.path.getsize(fnam) < data_end:
+        return False
+    if data_end == 0: #no checkpoint yet, the volume is started again
+        os.remove(fnam)
+        return True
+    if volume_is_closed(fnam, data_end):
+        return True
+    with open(fnam, 'r+b') as f:
+        if fnam.lower().endswith('.zip'):
+            try:
+                infos = zip_entries(f, data_end)
+            except (zipfile.BadZipFile, struct.error, UnicodeDecodeError):
+                return False
+            f.seek(data_end)
+            f.truncate()
+            handle = zipfile.ZipFile(f, 'w', allowZip64=True) #writes the index of infos at data_end on close
+            handle.filelist = infos
+            handle.NameToInfo = dict((info.filename, info) for info in infos)
+            handle.close()
+        else:
+            f.seek(data_end)
+            f.truncate()
+            blocks, remainder = divmod(data_end + 2*tarfile.BLOCKSIZE, tarfile.RECORDSIZE)
+            f.write(tarfile.NUL*(2*tarfile.BLOCKSIZE + (tarfile.RECORDSIZE-remainder if remainder else 0)))
+    print("%s was not closed by the last run, entries after its last checkpoint are dropped" %(fnam))
+    return True
+
+def open_archive(archive, volume_mb, conn):
+    """
+    The archive of a run is prepared for appending. Tiles recorded in volumes that no longer exist,
+    or in a volume that can not be repaired (it is renamed to .broken), are set back to planned.
+    Returns the archive state used by archive_add and archive_checkpoint. The last volume
+    is opened on the first tile added
+    """
+    volumes = archive_volumes(archive, volume_mb)
+    if volumes and not repair_volume(volumes[-1], conn):
+        print("%s is damaged, it is renamed to %s.broken and its tiles are produced again" %(volumes[-1], volumes[-1]))
+        os.replace(volumes[-1], volumes[-1]+'.broken')
+        with manifest_lock, conn:
+            conn.execute("DELETE FROM volumes WHERE name=?", (os.path.basename(volumes[-1]),))
+        volumes = volumes[:-1]
+    existing = set(os.path.basename(fnam) for fnam in volumes)
+    lost = [r[0] for r in conn.execute("SELECT basename, volume FROM tiles WHERE state='done' AND volume IS NOT NULL") if r[1] not in existing]
+    if lost:
+        print("%s tiles are not in the archive any more and are produced again" %(len(lost)))
+        manifest_reset_tiles(conn, lost)
+    name = volumes[-1] if volumes else volume_name(archive, volume_mb, 1)
+    return {'archive': archive, 'volume_mb': volume_mb, 'number': max(1, len(volumes)), 'name': name, 'handle': None,
+            'pending': [], 'checkpoint': time.time()}
+
+def archive_names(archive, volume_mb):
+    """
+    Returns the names of all entries in the volumes of an archive
+    """
+    names = set()
+    for fnam in archive_volumes(archive, volume_mb):
+        with open_volume(fnam, 'r') as handle:
+            names.update(handle.namelist() if isinstance(handle, zipfile.ZipFile) else handle.getnames())
+    return names
+
+def start_volume(state, conn):
+    """
+    The current volume is opened for appending. A new volume is recorded in the manifest first,
+    so a run interrupted before its first checkpoint is recognized as such on resume
+    """
+    if not os.path.isfile(state['name']):
+        manifest_store_volume(conn, os.path.basename(state['name']), 0, [])
+    state['handle'] = open_volume(state['name'], 'a')
+
+def archive_checkpoint(state, conn, close=False):
+    """
+    The entries of the open volume are flushed to disk and the checkpoint (the offset after the last
+    entry) is recorded in the manifest together with the tiles added since the last checkpoint - only
+    now they count as done. The volume is kept open unless close is set, which writes its index
+    (an interrupted run rebuilds it, see repair_volume). Returns the results of these tiles
+    """
+    handle = state['handle']
+    if handle is None:
+        return []
+    data_end = volume_data_end(handle)
+    if close:
+        handle.close()
+        state['handle'] = None
+    else:
+        f = handle.fp if isinstance(handle, zipfile.ZipFile) else handle.fileobj
+        f.flush()
+        os.fsync(f.fileno())
+    committed = state['pending']
+    manifest_store_volume(conn, os.path.basename(state['name']), data_end, committed)
+    state['pending'] = []
+    state['checkpoint'] = time.time()
+    return committed
+
+def archive_add(state, conn, result):
+    """
+    The tile and sidecar of a result (see write_stage) are added to the archive. With volumes a new
+    volume is started when the tile would not fit into the current one any more (a tile and its sidecar
+    are always in the same volume). Returns the results committed by a checkpoint (usually none)
+    """
+    t = time.time()
+    data = result.pop('data')
+    text = result.pop('sidecar').encode('utf-8')
+    committed = []
+    limit = state['volume_mb']*1024*1024
+    if state['handle'] is None:
+        start_volume(state, conn)
+    used = volume_data_end(state['handle'])
+    if limit > 0 and used > 0 and used + len(data) + len(text) > limit:
+        committed = archive_checkpoint(state, conn, close=True)
+        state['number'] = state['number'] +1
+        state['name'] = volume_name(state['archive'], state['volume_mb'], state['number'])
+        start_volume(state, conn)
+        dp ("Starting volume %s" %(state['name']))
+    add_to_volume(state['handle'], result['basename']+'.tif', data)
+    add_to_volume(state['handle'], result['basename']+'.xml', text, compress=True)
+    result['volume'] = os.path.basename(state['name'])
+    result['timings']['archive'] = time.time() - t
+    state['pending'].append(result)
+    if len(state['pending']) >= ARCHIVE_CHECKPOINT_TILES or time.time() - state['checkpoint'] > ARCHIVE_CHECKPOINT_SEC:
+        committed = committed + archive_checkpoint(state, conn)
+    return committed
+
+def read_vsi(fnam):
+    """
+    The content of a file read through GDAL (e.g. /vsimem/ or a file in an archive)
+    """
+    size = gdal.VSIStatL(fnam).size
+    f = gdal.VSIFOpenL(fnam, 'rb')
+    try:
+        return gdal.VSIFReadL(1, size, f)
+    finally:
+        gdal.VSIFCloseL(f)
+
+def read_vsimem(fnam):
+    """
+    The content of a /vsimem/ file, which is removed
+    """
+    try:
+        return read_vsi(fnam)
+    finally:
+        gdal.Unlink(fnam)
+
+#*--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--*
+#Following functions run the planned tiles, either in this process or in a pool of workers.
+#A tile is a dict with the keys basename, level, epsg, row, bounds (minx, miny, maxx, maxy), xres, yres and gsd
+
+settings = {} #settings shared by all tiles of a run: input_raster, output_folder, template, gdal_edit, strip_mb,
+              #distributed, node_id, lease_sec, timing_log, co_profile, blocksize, overviews,
+              #warp_threads, warp_mem, cache_mb, writer_threads, zone_sources, keep_open, keywords,
+              #input_sources, archive, volume_mb, verbose
+
+def init_worker(run_settings, keep_open=()):
+    """
+    Initializer for the worker processes. Each worker gets a copy of the run settings
+    and opens (and keeps) its own handle to the input raster on the first tile.
+    In the main process keep_open names datasets kept open between runs (see dem2dged_api.py)
+    """
+    global settings, debug
+    settings = run_settings
+    debug = run_settings['verbose']
+    close_sources(keep_open) #datasets inherited from the parent process are not shared
+    if settings.get('cache_mb'):
+        gdal.SetCacheMax(settings['cache_mb']*1024*1024)
+    if settings.get('distributed'):
+        start_heartbeat()
+
+session_lock = threading.RLock()
+
+@contextlib.contextmanager
+def session_state(run_settings, sources):
+    """
+    The module state (settings, verbosity and the cache of open sources) is used by one caller at
+    a time. A session (see dem2dged_api.py) runs with its own settings and its own dict of open
+    sources, and the state it replaced is restored afterwards
+    """
+    global settings, debug, source_cache
+    with session_lock:
+        saved = settings, debug, source_cache
+        settings, debug, source_cache = run_settings, run_settings['verbose'], sources
+        try:
+            yield
+        finally:
+            settings, debug, source_cache = saved
+
+def tile_filenames(tile):
+    """
+    Returns the names of the tif and the sidecar xml of a tile
+    """
+    namnam = os.path.join(settings['output_folder'], tile['basename']+'.tif')
+    xmlnam = os.path.join(settings['output_folder'], tile['basename']+'.xml')
+    return namnam, xmlnam
+
+def part_name(fnam):
+    """
+    The temporary name a file is written under until it is complete. It is unique per node and
+    process, so nodes of a distributed run never write into each other's files
+    """
+    return "%s.part.%s.%s" %(fnam, settings.get('node_id') or socket.gethostname(), os.getpid())
+
+def tile_source(tile):
+    """
+    The source a tile is warped from: the input raster, or for a coarser level of a multi-zone
+    run the level vrt of the tile's own zone (a vrt can only hold tiles of one srs)
+    """
+    return settings.get('zone_sources', {}).get(str(tile['epsg']), settings['input_raster'])
+
+def tile_statistics(ds):
+    """
+    Elevation statistics of an in-memory tile (nodata -32767 excluded). They are set as the GeoTIFF
+    statistics of the band, so they are written with the tile and need no second read.
+    Returns min_elev, max_elev, mean_elev and void_pct (min, max and mean are None for an empty tile)
+    """
+    band = ds.GetRasterBand(1)
+    arr = band.ReadAsArray()
+    valid = arr != -32767
+    if arr.dtype.kind == 'f':
+        valid &= np.isfinite(arr)
+    numvalid = int(np.count_nonzero(valid))
+    stats = {'void_pct': 100.0*(arr.size-numvalid)/arr.size if arr.size else 100.0}
+    if numvalid == 0:
+        stats.update({'min_elev': None, 'max_elev': None, 'mean_elev': None})
+        return stats
+    #reduced in place on the tile (no copy of the valid values), accumulated in float64
+    limits = np.finfo(arr.dtype) if arr.dtype.kind == 'f' else np.iinfo(arr.dtype)
+    stats.update({'min_elev': float(arr.min(where=valid, initial=limits.max)),
+                  'max_elev': float(arr.max(where=valid, initial=limits.min)),
+                  'mean_elev': float(arr.mean(dtype=np.float64, where=valid))})
+    band.SetStatistics(stats['min_elev'], stats['max_elev'], stats['mean_elev'], float(arr.std(dtype=np.float64, where=valid)))
+    band.SetMetadataItem('STATISTICS_VALID_PERCENT', "%.4f" %(100.0-stats['void_pct']))
+    return stats
+
+def sidecar_epsg(epsg):
+    """
+    The value of the {{EPSG}} keyword of a sidecar
+    """
+    return "EPSG:"+str(epsg)
+
+def sidecar_keywords(tile, result):
+    """
+    The keywords of the sidecar of a tile: name, level, srs, bounds, checksum, the elevation
+    statistics of the result and the extra keywords of the run (settings['keywords'])
+    """
+    minx, miny, maxx, maxy = tile['bounds']
+    keywords = dict(settings.get('keywords') or {})
+    keywords.update({'BASENAME': tile['basename'], 'LEVEL': tile['level'], 'GSD': tile['gsd'],
+                     'DATE': datetime.date.today(), 'EPSG': sidecar_epsg(tile['epsg']),
+                     'MINX': minx, 'MINY': miny, 'MAXX': maxx, 'MAXY': maxy, 'CHECKSUM': result.get('checksum')})
+    for name in TILE_STAT_COLUMNS:
+        if result.get(name) is not None:
+            keywords[name.upper()] = ("%.2f" if name == 'void_pct' else "%.3f") %(result[name])
+        elif name in result: #a tile without data has no elevations
+            keywords[name.upper()] = ""
+    return keywords
+
+def tile_sidecar(tile, result):
+    """
+    The sidecar text of a produced tile. For a tile without data the vertical extent of the
+    template (minimumValue/maximumValue holding {{MIN_ELEV}}/{{MAX_ELEV}}) is marked as missing
+    """
+    template = settings['template']
+    if 'min_elev' in result and result['min_elev'] is None:
+        if template not in nil_templates:
+            nil_templates[template] = NIL_EXTENT_PATTERN.sub(r'<gmd:\1 gco:nilReason="missing"/>', template)
+        template = nil_templates[template]
+    return render_sidecar(template, sidecar_keywords(tile, result))
+
+#Sidecars are written by a background thread in batches, while the next tiles are warped.
+#A unit of work (see run_tiles) waits for its sidecars once, before its results are reported
+UNIT_TILES = 16 #tiles in a unit of work (unless rows of tiles are the unit)
+sidecar_queue = None
+sidecar_pid = None #process owning the writer thread
+sidecar_errors = {}
+sidecar_lock = threading.Lock()
+
+def sidecar_writer():
+    """
+    Background writer: queued sidecars are taken in batches and written (under a temporary
+    name, renamed when complete)
+    """
+    while True:
+        batch = [sidecar_queue.get()]
+        while len(batch) < 64:
+            try:
+                batch.append(sidecar_queue.get_nowait())
+            except queue.Empty:
+                break
+        for basename, fnam, text in batch:
+            try:
+                with open(part_name(fnam), "wt") as f:
+                    f.write(text)
+                os.replace(part_name(fnam), fnam)
+            except Exception as e:
+                sidecar_errors[basename] = str(e)
+            sidecar_queue.task_done()
+
+def queue_sidecar(basename, fnam, text):
+    """
+    A rendered sidecar is queued for the background writer (started on first use in each process)
+    """
+    global sidecar_queue, sidecar_pid
+    with sidecar_lock:
+        if sidecar_pid != os.getpid(): #a forked worker starts its own
+            sidecar_queue = queue.Queue()
+            sidecar_pid = os.getpid()
+            sidecar_errors.clear()
+            threading.Thread(target=sidecar_writer, daemon=True).start()
+    sidecar_queue.put((basename, fnam, text))
+
+def finish_sidecars(results):
+    """
+    Waits until the queued sidecars are written. Tiles whose sidecar could not be written are failed.
+    Returns the results
+    """
+    if sidecar_pid != os.getpid():
+        return results
+    sidecar_queue.join()
+    for result in results:
+        error = sidecar_errors.pop(result['basename'], None)
+        if error is not None and result.get('state') == 'done':
+            print("Tile %s failed: %s" %(result['basename'], error))
+            result['state'] = 'failed'
+            result['error'] = error
+    return results
+
+def warp_stage(tile, src=None):
+    """
+    First stage of a tile: it is warped into memory (from the input raster unless another
+    source, e.g. a strip buffer, is given). Returns the result dict (see render_tile) and the
+    in-memory dataset (None if the warp failed)
+    """
+    if src is None:
+        src = tile_source(tile)
+        if settings.get('input_sources') and src == settings['input_raster']: #batch input
+            src = select_sources(tile) or [open_batch_source(settings['input_sources'][0]['path'])] #an empty tile
+    minx, miny, maxx, maxy = tile['bounds']
+    result = {'basename': tile['basename'], 'started': time.time()}
+    result['timings'] = dict(tile.get('timings', {})) #from the resume check
+    dp(" ")
+    dp("-"*70)
+    dp("Creating elevation raster %s" %(tile['basename']))
+    try:
+        t = time.time()
+        ds = warp_to_mem(src, tile['epsg'], minx, miny, maxx, maxy, tile['xres'], tile['yres'])
+        result['timings']['warp'] = time.time() - t
+        t = time.time()
+        result.update(tile_statistics(ds)) #while the tile is still in memory
+        result['timings']['stats'] = time.time() - t
+    except Exception as e:
+        print("Tile %s failed: %s" %(tile['basename'], e))
+        result['state'] = 'failed'
+        result['error'] = str(e)
+        ds = None
+    return result, ds
+
+def write_stage(tile, ds, result):
+    """
+    Second stage of a tile: the in-memory tile is compressed to a /vsimem/ buffer, hashed, and written,
+    and its sidecar metadata file is rendered and queued for the background writer. Both files are written
+    under a temporary name and renamed when complete, so a tile is never half-written.
+    When the output is an archive the bytes and sidecar text are returned in the result instead
+    (keys data and sidecar) for archive_add. Returns the result
+    """
+    namnam, xmlnam = tile_filenames(tile)
+    timings = result['timings']
+    if ds is not None:
+        try:
+            t = time.time()
+            memnam = '/vsimem/dem2dged_%s_%s.tif' %(os.getpid(), tile['basename'])
+            write_tile(ds, memnam, get_creation_options(settings.get('co_profile', 'lzw'), ds,
+                                                        settings.get('blocksize', 256), settings.get('overviews')))
+            ds = None
+            data = read_vsimem(memnam)
+            result['bytes'] = len(data)
+            result['checksum'] = hashlib.sha256(data).hexdigest()
+            if settings.get('archive'):
+                timings['write'] = time.time() - t
+                t = time.time()
+                result['sidecar'] = tile_sidecar(tile, result)
+                timings['sidecar'] = time.time() - t
+                result['data'] = data
+                result['state'] = 'done' #once added to the archive (see archive_add)
+            else:
+                partnam = part_name(namnam)
+                with open(partnam, 'wb') as f:
+                    f.write(data)
+                data = None
+                timings['write'] = time.time() - t
+                if settings['gdal_edit']:
+                    dp("Adjusting tiff header")
+                    t = time.time()
+                    fix_header_with_gdal_edit(partnam, tile['epsg'])
+                    #the header is changed in place, so the stored bytes differ from the buffer
+                    result['bytes'] = os.path.getsize(partnam)
+                    result['checksum'] = file_checksum(partnam)
+                    timings['header'] = time.time() - t
+                os.replace(partnam, namnam)
+                dp("creating sidecar metadata file")
+                t = time.time()
+                queue_sidecar(tile['basename'], xmlnam, tile_sidecar(tile, result))
+                timings['sidecar'] = time.time() - t
+                result['state'] = 'done' #once the sidecar is written (see finish_sidecars)
+        except Exception as e:
+            print("Tile %s failed: %s" %(tile['basename'], e))
+            result['state'] = 'failed'
+            result['error'] = str(e)
+    result['finished'] = time.time()
+    result['seconds'] = result['finished'] - result['started']
+    dp("-"*70)
+    dp(" ")
+    return result
+
+def render_tile(tile, src=None):
+    """
+    A tile is warped, written and its sidecar metadata file is created.
+    Returns a result dict (basename, state, timings, size, checksum and error if failed)
+    """
+    result, ds = warp_stage(tile, src)
+    return finish_sidecars([write_stage(tile, ds, result)])[0]
+
+def render_pipelined(tiles, src=None):
+    """
+    Producer/consumer pipeline: tiles are warped in this thread while writer threads compress
+    and write finished tiles and their sidecars. The queue between them is bounded, so the
+    warper waits (backpressure) instead of piling up tiles in memory when the disk is slow.
+    Returns a list of results
+    """
+    nwriters = settings['writer_threads']
+    pending = queue.Queue(maxsize=nwriters*2)
+    results = []
+    lock = threading.Lock()
+
+    def writer():
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            result = write_stage(*item)
+            with lock:
+                results.append(result)
+
+    writers = [threading.Thread(target=writer, daemon=True) for i in range(nwriters)]
+    for w in writers:
+        w.start()
+    try:
+        for tile in tiles:
+            result, ds = warp_stage(tile, src)
+            pending.put((tile, ds, result)) #blocks while the writers are behind
+    finally:
+        for w in writers:
+            pending.put(None)
+        for w in writers:
+            w.join()
+    return results
+
+def render_tiles(tiles, src=None):
+    """
+    Tiles are produced from the input raster (or another source, e.g. a strip buffer), through
+    the writer pipeline if writer threads are enabled. Returns a list of results
+    """
+    if settings.get('writer_threads', 0) > 0 and len(tiles) > 1:
+        return finish_sidecars(render_pipelined(tiles, src))
+    results = []
+    for tile in tiles:
+        result, ds = warp_stage(tile, src)
+        results.append(write_stage(tile, ds, result))
+    return finish_sidecars(results)
+
+stage_totals = {} #accumulated seconds per stage of the run (planning, warp, stats, write, header, sidecar, archive) and tile count
+tile_timings = [] #(basename, seconds, stage timings) of every tile produced, for the timing summary
+
+def add_stage_time(stage, seconds):
+    """
+    Time spent in a stage is added to the totals of the run
+    """
+    stage_totals[stage] = stage_totals.get(stage, 0) + seconds
+
+def percentile(values, p):
+    """
+    The p'th percentile (nearest rank) of a list of values
+    """
+    values = sorted(values)
+    return values[min(len(values)-1, max(0, int(math.ceil(p/100.0*len(values)))-1))]
+
+def print_timing_summary(slowest=10):
+    """
+    p50, p95 and max per stage and the slowest tiles of the run are printed
+    """
+    if not tile_timings:
+        return
+    stages = {}
+    for basename, seconds, timings in tile_timings:
+        for stage, t in timings.items():
+            stages.setdefault(stage, []).append(t)
+    print("%-14s %8s %10s %10s %10s %10s" %("stage", "tiles", "p50 [s]", "p95 [s]", "max [s]", "total [s]"))
+    for stage in sorted(stages):
+        v = stages[stage]
+        print("%-14s %8s %10.4f %10.4f %10.4f %10.2f" %(stage, len(v), percentile(v, 50), percentile(v, 95), max(v), sum(v)))
+    print("Slowest tiles:")
+    for basename, seconds, timings in sorted(tile_timings, key=lambda r: -r[1])[:slowest]:
+        print("%10.3f s  %s" %(seconds, basename))
+
+def log_tile_timing(f, result):
+    """
+    The timing of a tile is written as a JSON line
+    """
+    f.write(json.dumps({'basename': result['basename'], 'state': result['state'], 'seconds': result.get('seconds'),
+                        'stages': result.get('timings', {})}) + "\n")
+
+def record_result(conn, result, stored=False):
+    """
+    The result of a tile is written to the manifest (unless stored already, see archive_checkpoint)
+    and its stage timings to the run totals
+    """
+    fields = dict(result)
+    basename = fields.pop('basename')
+    state = fields.pop('state')
+    timings = fields.pop('timings', {})
+    for stage, seconds in timings.items():
+        add_stage_time(stage, seconds)
+    if 'seconds' in fields:
+        tile_timings.append((basename, fields['seconds'], timings))
+    if state == 'done':
+        add_stage_time('tiles', 1)
+    if not stored:
+        manifest_set_state(conn, basename, state, **fields)
+
+def use_settings(task):
+    """
+    Worker function of a pool shared by several runs (see run_tiles): the settings of the run are
+    taken over if they changed, then the unit is rendered. Datasets of earlier runs are released,
+    the rest of the worker state (GDAL, srs and transform caches, compiled templates) is kept warm
+    """
+    worker, run_settings, unit = task
+    global settings, debug
+    if settings != run_settings:
+        close_sources() #the input may have changed, even under the same name (e.g. a mosaic vrt)
+        settings = run_settings
+        debug = run_settings['verbose']
+        if settings.get('cache_mb'):
+            gdal.SetCacheMax(settings['cache_mb']*1024*1024)
+    return worker(unit)
+
+def run_tiles(tiles, run_settings, jobs=1, pool=None):
+    """
+    All planned tiles are produced. The tiles are registered in the manifest of the output
+    folder and tiles already done there are skipped (allowing to continue an interrupted run).
+    Output from before the manifest existed is recognized by its sidecar xml.
+    With jobs > 1 the remaining tiles are spread over a pool of worker processes. A pool kept
+    by the caller (see dem2dged_watch.py) can be given instead; it is left open.
+    If the output is an archive, the tiles are added to it as they come back from the workers
+    and counted as done at the next checkpoint of the archive.
+    Returns the number of failed tiles
+    """
+    init_worker(run_settings, run_settings.get('keep_open', ()))
+    conn = open_manifest(run_settings['output_folder'], manifest_name(run_settings))
+    fresh = conn.execute("SELECT COUNT(*) FROM tiles").fetchone()[0] == 0
+    manifest_add_tiles(conn, tiles)
+    for level in set(tile['level'] for tile in tiles):
+        manifest_store_settings(conn, run_settings, level)
+    archive = None
+    archived = set()
+    if run_settings.get('archive'):
+        archive = open_archive(run_settings['archive'], run_settings.get('volume_mb', 0), conn)
+        if fresh: #resuming into an archive written without this manifest
+            archived = archive_names(run_settings['archive'], run_settings.get('volume_mb', 0))
+    done = manifest_get_basenames(conn, 'done')
+    numfiles = len(tiles)
+    numdone = 0
+    numfailed = 0
+    todo = []
+    resume_started = time.perf_counter()
+    for tile in tiles:
+        t = time.perf_counter()
+        if tile['basename'] in done:
+            numdone = numdone +1
+            continue
+        if archive is not None and tile['basename']+'.xml' in archived:
+            manifest_set_state(conn, tile['basename'], 'done')
+            numdone = numdone +1
+            continue
+        if fresh and archive is None and os.path.isfile(tile_filenames(tile)[1]): #produced before the manifest was introduced
+            manifest_set_state(conn, tile['basename'], 'done')
+            numdone = numdone +1
+            continue
+        tile.setdefault('timings', {})['resume_check'] = time.perf_counter() - t
+        todo.append(tile)
+    add_stage_time('resume_total', time.perf_counter() - resume_started)
+    if numdone > 0:
+        print("%s tiles already exist, continuing with the remaining %s" %(numdone, len(todo)))
+    dp ("%s of %s tiles to be produced using %s job(s)" %(len(todo), numfiles, jobs))
+
+    #with strip buffering a row of tiles is the unit of work, otherwise a chunk of tiles
+    if run_settings.get('strip_mb', 0) > 0:
+        worker = render_row
+        units = group_tiles_by_row(todo)
+    else:
+        #a chunk of tiles is the unit, so warping and writing (tiles and sidecars) can overlap.
+        #Every job gets at least four units
+        worker = render_tiles
+        chunk = max(4*run_settings.get('writer_threads', 0), min(UNIT_TILES, len(todo)//(4*max(1, jobs))), 1)
+        units = [todo[i:i+chunk] for i in range(0, len(todo), chunk)]
+    if run_settings.get('distributed'):
+        worker = render_claimed
+        os.makedirs(os.path.join(run_settings['output_folder'], QUEUE_DIR), exist_ok=True)
+        print("Running as node %s in distributed mode" %(run_settings['node_id']))
+
+    #the pool takes units from dispatch as fast as it can, so only a few units per job are let
+    #ahead of the results; a unit is marked warping (in one transaction) when it is let through
+    inflight = threading.Semaphore(2*max(1, jobs))
+    stopping = threading.Event()
+    def dispatch(pending):
+        for unit in pending:
+            while not inflight.acquire(timeout=1):
+                if stopping.is_set():
+                    return
+            if stopping.is_set():
+                return
+            if not run_settings.get('distributed'):
+                manifest_set_states(conn, [tile['basename'] for tile in unit], 'warping')
+            yield unit
+
+    timing_log = None
+    if run_settings.get('timing_log'):
+        timing_log = open(run_settings['timing_log'], 'a')
+
+    def count(result, stored=False):
+        nonlocal numdone, numfailed
+        if timing_log is not None and 'seconds' in result:
+            log_tile_timing(timing_log, result)
+        record_result(conn, result, stored)
+        numdone = numdone +1
+        if result['state'] == 'failed':
+            numfailed = numfailed +1
+        print ("%s %% done " %(int(100*numdone/numfiles)))
+
+    busy = []
+    def report(results):
+        inflight.release()
+        for result in results:
+            if result['state'] == 'busy': #claimed by another node
+                busy.append(result['basename'])
+                continue
+            if archive is not None and result['state'] == 'done':
+                for committed in archive_add(archive, conn, result):
+                    count(committed, True)
+                continue
+            count(result)
+
+    shared = pool is not None
+    if pool is None and jobs > 1 and len(units) > 1:
+        pool = multiprocessing.Pool(jobs, initializer=init_worker, initargs=(run_settings,))
+    try:
+        #in distributed mode units claimed by other nodes are checked again until they are
+        #finished (or their claim goes stale and is taken over)
+        pending = units
+        while pending:
+            if pool is None:
+                for unit in dispatch(pending):
+                    report(worker(unit))
+            elif shared: #the workers take over the settings of this run
+                for results in pool.imap_unordered(use_settings, ((worker, run_settings, unit) for unit in dispatch(pending))):
+                    report(results)
+            else:
+                for results in pool.imap_unordered(worker, dispatch(pending)):
+                    report(results)
+            waiting = set(busy)
+            pending = [[tile for tile in unit if tile['basename'] in waiting] for unit in pending]
+            pending = [unit for unit in pending if unit]
+            del busy[:]
+            if pending:
+                dp ("%s tiles are claimed by other nodes, waiting" %(len(waiting)))
+                time.sleep(max(1, run_settings['lease_sec']/4))
+    except BaseException:
+        stopping.set() #a dispatch waiting for a free slot gives up, so the pool can be stopped
+        if pool is not None and not shared:
+            pool.terminate()
+        raise
+    finally:
+        if archive is not None: #tiles added so far are kept, also if the run is interrupted
+            for committed in archive_checkpoint(archive, conn, close=True):
+                count(committed, True)
+        if timing_log is not None:
+            timing_log.close()
+    if pool is not None and not shared:
+        pool.close()
+        pool.join()
+    close_sources(run_settings.get('keep_open', ()))
+    conn.close()
+    if numfailed > 0:
+        name = manifest_name(run_settings)
+        print("%s tiles failed - see the manifest (python dem2dged_manifest.py status %s%s)" %(numfailed, run_settings['output_folder'],
+                                                                                             "" if name == MANIFEST_NAME else " -manifest "+name))
+    return numfailed
+
+def get_input_sources(rasras):
+    """
+    The current sources of the input with path, mtime, size and extent (in the coordinates
+    of the input). For a vrt these are the vrt itself and every file it references,
+    otherwise just the input raster
+    """
+    src = open_source(rasras)
+    ulx, xres, xskew, uly, yskew, yres = src.GetGeoTransform()
+    full = (min(ulx, ulx + src.RasterXSize*xres), min(uly, uly + src.RasterYSize*yres),
+            max(ulx, ulx + src.RasterXSize*xres), max(uly, uly + src.RasterYSize*yres))
+    entries = [(rasras, full)] + (get_vrt_sources(src) or [])
+    sources = []
+    for fnam, extent in entries:
+        path = os.path.abspath(fnam)
+        try:
+            st = os.stat(path)
+            mtime, size = st.st_mtime, st.st_size
+        except OSError: #e.g. /vsicurl/ sources - assumed unchanged
+            mtime, size = 0, 0
+        sources.append({'path': path, 'mtime': mtime, 'size': size, 'extent': extent})
+    return sources
+
+def get_changed_extents(previous, sources, halo):
+    """
+    The extents of sources that are new, modified or removed since the previous run, grown by
+    a halo (in the coordinates of the input). A changed vrt is only a change in the list of sources,
+    so the vrt entry itself is left out when the vrt references sources
+    """
+    current = dict((s['path'], s) for s in sources)
+    changed = []
+    for path, s in current.items():
+        old = previous.get(path)
+        if old is None or old['mtime'] != s['mtime'] or old['size'] != s['size']:
+            changed.append(s)
+    for path, old in previous.items():
+        if path not in current:
+            changed.append(old)
+    if len(sources) > 1:
+        changed = [s for s in changed if s['path'] != sources[0]['path']]
+    return [(s['extent'][0]-halo, s['extent'][1]-halo, s['extent'][2]+halo, s['extent'][3]+halo) for s in changed]
+
+def get_touched_tiles(tiles, extents, src_epsg):
+    """
+    Tiles intersecting any of the changed extents (in EPSG:src_epsg). Tiles are grown by two
+    output pixels to include the cubic kernel
+    """
+    boxes = {}
+    touched = []
+    for tile in tiles:
+        if tile['epsg'] not in boxes:
+            boxes[tile['epsg']] = [transform_bounds(e[0], e[1], e[2], e[3], src_epsg, tile['epsg'], densify=16) for e in extents]
+        minx, miny, maxx, maxy = tile['bounds']
+        hx = 2*tile['xres']
+        hy = 2*tile['yres']
+        for b in boxes[tile['epsg']]:
+            if minx-hx < b[2] and maxx+hx > b[0] and miny-hy < b[3] and maxy+hy > b[1]:
+                touched.append(tile)
+                break
+    return touched
+
+def build_level_vrt(output_folder, vrtnam, tiles):
+    """
+    A vrt over the produced tiles of a level. It is used as the source for the next coarser
+    level, so the original input is only read once when producing several levels
+    """
+    vrtnam = os.path.join(output_folder, vrtnam)
+    files = []
+    for tile in tiles:
+        namnam = os.path.join(output_folder, tile['basename']+'.tif')
+        if os.path.isfile(namnam):
+            files.append(namnam)
+    dp ("Building %s from %s tiles" %(vrtnam, len(files)))
+    opts = gdal.BuildVRTOptions(resolution='highest', srcNodata=-32767, VRTNodata=-32767)
+    vrt = gdal.BuildVRT(vrtnam, files, options=opts)
+    if vrt is None:
+        raise RuntimeError("Unable to build %s: %s" %(vrtnam, gdal.GetLastErrorMsg()))
+    vrt = None #flush and close
+    return vrtnam
+
+def run_levels(level_tiles, run_settings, jobs=1, incremental=False):
+    """
+    One or more product levels are produced. level_tiles is a list of (level, tiles) with the
+    finest level first. The finest level is produced from the input raster and every coarser level
+    from a vrt over the level before it. If tiles of a level fail, the coarser levels are not produced
+    (they would be derived from an incomplete level). The vrts are removed when all tiles succeeded. When the output is an archive the tiles are not
+    on disk, so every level is produced from the input raster.
+    The input sources are recorded in the manifest after a successful run. In incremental mode
+    tiles touched by sources changed since then are produced again (including their sidecars).
+    Returns the number of failed tiles
+    """
+    numfailed = 0
+    vrts = []
+    source = run_settings['input_raster']
+    zone_sources = {}
+    conn = open_manifest(run_settings['output_folder'], manifest_name(run_settings))
+    sources = get_input_sources(source)
+    if incremental:
+        previous = manifest_load_sources(conn)
+        if not previous:
+            print("No input sources recorded by a previous run - nothing to compare with")
+        else:
+            src = open_source(source)
+            ulx, xres, xskew, uly, yskew, yres = src.GetGeoTransform()
+            extents = get_changed_extents(previous, sources, 2*max(abs(xres), abs(yres)))
+            print("%s input sources changed since the last run" %(len(extents)))
+            for level, tiles in level_tiles:
+                touched = get_touched_tiles(tiles, extents, get_source_epsg(src)) if extents else []
+                print("Level %s: %s tiles are produced again" %(level, len(touched)))
+                manifest_reset_tiles(conn, [tile['basename'] for tile in touched])
+    for i, (level, tiles) in enumerate(level_tiles):
+        if len(level_tiles) > 1:
+            print("Producing level %s (%s tiles) from %s" %(level, len(tiles), ", ".join(sorted(zone_sources.values())) or source))
+        level_settings = dict(run_settings)
+        level_settings['input_raster'] = source
+        level_settings['zone_sources'] = zone_sources
+        if i > 0 and not run_settings.get('archive'): #coarser levels are read from the level vrt, not from the batch inputs
+            level_settings['input_sources'] = None
+        level_failed = run_tiles(tiles, level_settings, jobs)
+        numfailed = numfailed + level_failed
+        if level_failed > 0 and i < len(level_tiles)-1 and not run_settings.get('archive'):
+            #a level vrt with holes would give coarser tiles with holes, recorded as done
+            print("Level %s has %s failed tiles, level(s) %s are not produced. Run the same command again to retry the failed tiles and produce them" %(
+                  level, level_failed, ", ".join(l for l, t in level_tiles[i+1:])))
+            break
+        if i < len(level_tiles)-1 and not run_settings.get('archive'):
+            zones = {}
+            for tile in tiles:
+                zones.setdefault(tile['epsg'], []).append(tile)
+            zone_sources = {}
+            for epsg in sorted(zones):
+                vrtnam = "dem2dged_level_%s" %(level)
+                if len(zones) > 1: #multi-zone run, one vrt per zone
+                    vrtnam = vrtnam + "_%s" %(epsg)
+                if run_settings.get('distributed'): #each node builds its own
+                    vrtnam = vrtnam + "_%s" %(run_settings['node_id'])
+                source = build_level_vrt(run_settings['output_folder'], vrtnam+".vrt", zones[epsg])
+                vrts.append(source)
+                if len(zones) > 1:
+                    zone_sources[str(epsg)] = source
+    if numfailed == 0:
+        for vrtnam in vrts:
+            os.remove(vrtnam)
+        manifest_store_sources(conn, sources)
+    conn.close()
+    return numfailed
+
+def compare_creation_profiles(tiles, run_settings, profiles=None, reads=16):
+    """
+    The creation profiles are compared on a sample of tiles. Every tile is warped once and
+    written with each profile to a temporary folder in the output folder (so the target disk is
+    measured). Reported per profile are total size, write time, full read time and the time for
+    a number of random 256x256 window reads (the access pattern of viewers). The window reads use a
+    new handle, so they are not served from the blocks cached by the full read
+    """
+    init_worker(run_settings)
+    if profiles is None:
+        profiles = sorted(CREATION_PROFILES)
+    tmpdir = tempfile.mkdtemp(prefix='dem2dged_compare_', dir=run_settings['output_folder'])
+    stats = dict((p, {'bytes': 0, 'write': 0.0, 'read': 0.0, 'random_read': 0.0}) for p in profiles)
+    rnd = random.Random(42)
+    try:
+        for tile in tiles:
+            minx, miny, maxx, maxy = tile['bounds']
+            ds = warp_to_mem(settings['input_raster'], tile['epsg'], minx, miny, maxx, maxy, tile['xres'], tile['yres'])
+            for profile in profiles:
+                fnam = os.path.join(tmpdir, "%s_%s.tif" %(tile['basename'], profile))
+                t = time.perf_counter()
+                write_tile(ds, fnam, get_creation_options(profile, ds, run_settings.get('blocksize', 256), run_settings.get('overviews')))
+                stats[profile]['write'] += time.perf_counter() - t
+                stats[profile]['bytes'] += os.path.getsize(fnam)
+                t = time.perf_counter()
+                check = gdal.Open(fnam)
+                check.GetRasterBand(1).ReadRaster()
+                stats[profile]['read'] += time.perf_counter() - t
+                check = None #closing drops its blocks from the GDAL block cache
+                check = gdal.Open(fnam)
+                t = time.perf_counter()
+                band = check.GetRasterBand(1)
+                w = min(256, check.RasterXSize)
+                h = min(256, check.RasterYSize)
+                for i in range(reads):
+                    band.ReadRaster(rnd.randint(0, check.RasterXSize-w), rnd.randint(0, check.RasterYSize-h), w, h)
+                stats[profile]['random_read'] += time.perf_counter() - t
+                check = None
+            ds = None
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    print("Creation profiles compared on %s tiles" %(len(tiles)))
+    print("%-10s %14s %12s %12s %16s" %("profile", "bytes", "write [s]", "read [s]", "random read [s]"))
+    for profile in profiles:
+        st = stats[profile]
+        print("%-10s %14s %12.3f %12.3f %16.3f" %(profile, st['bytes'], st['write'], st['read'], st['random_read']))
+    return stats
+
+def random_tiles(tiles, count, seed=42):
+    """
+    count tiles picked at random (the same for every run), e.g. for comparing creation profiles
+    on typical tiles rather than the edge tiles first in the plan
+    """
+    return random.Random(seed).sample(tiles, min(count, len(tiles)))
+
+def sample_tiles(tiles, count):
+    """
+    count tiles spread evenly over the list (so the sample covers the whole area)
+    """
+    if count <= 0 or not tiles:
+        return []
+    step = max(1, len(tiles)//count)
+    return tiles[step//2::step][:count]
+
+def estimate_level_source(tmpdir, tile, finer_tiles, made):
+    """
+    The source of a sample tile of a coarser level: a vrt over the tiles of the level before it that
+    intersect the tile (grown by the cubic kernel). These tiles are warped from the input into tmpdir
+    (made holds those written already). Returns the name of the vrt
+    """
+    minx, miny, maxx, maxy = tile['bounds']
+    hx = 2*tile['xres']
+    hy = 2*tile['yres']
+    files = []
+    for other in finer_tiles:
+        ox0, oy0, ox1, oy1 = other['bounds']
+        if other['epsg'] != tile['epsg'] or ox0 >= maxx+hx or ox1 <= minx-hx or oy0 >= maxy+hy or oy1 <= miny-hy:
+            continue
+        if other['basename'] not in made:
+            fnam = os.path.join(tmpdir, "finer_%s.tif" %(other['basename']))
+            ds = warp_to_mem(settings['input_raster'], other['epsg'], ox0, oy0, ox1, oy1, other['xres'], other['yres'])
+            write_tile(ds, fnam)
+            ds = None
+            made[other['basename']] = fnam
+        files.append(made[other['basename']])
+    if not files: #no data there (the tiles of the level before were pruned)
+        return settings['input_raster']
+    vrtnam = os.path.join(tmpdir, "source_%s.vrt" %(tile['basename']))
+    vrt = gdal.BuildVRT(vrtnam, files, options=gdal.BuildVRTOptions(resolution='highest', srcNodata=-32767, VRTNodata=-32767))
+    if vrt is None:
+        raise RuntimeError("Unable to build %s: %s" %(vrtnam, gdal.GetLastErrorMsg()))
+    vrt = None #flush and close
+    return vrtnam
+
+def estimate_run(level_tiles, run_settings, jobs=1, sample=8):
+    """
+    Dry run: the tile count, output size and wall time of a run are estimated without producing
+    the product. Per level a sample of tiles is warped and written (with the creation profile of the
+    run) to a temporary folder in the output folder. The sample gives the share of non-empty tiles,
+    the compression ratio and the time per tile, which are scaled to all tiles of the level.
+    As in a real run a coarser level is warped from a vrt over the tiles of the level before it
+    (see estimate_level_source), unless the output is an archive.
+    Returns a list of per level estimates (dicts)
+    """
+    init_worker(run_settings, run_settings.get('keep_open', ()))
+    tmpdir = tempfile.mkdtemp(prefix='dem2dged_estimate_', dir=run_settings['output_folder'])
+    estimates = []
+    try:
+        for i, (level, tiles) in enumerate(level_tiles):
+            pixels = 0
+            for tile in tiles:
+                minx, miny, maxx, maxy = tile['bounds']
+                pixels = pixels + int(round((maxx-minx)/tile['xres'])) * int(round((maxy-miny)/tile['yres']))
+            est = {'level': level, 'tiles': len(tiles), 'pixels': pixels, 'sampled': 0, 'nonempty': None,
+                   'uncompressed_bytes': pixels*4, 'compressed_bytes': None, 'sec_per_tile': None, 'wall_s': None}
+            sampled = sample_tiles(tiles, sample)
+            nonempty = 0
+            pixel_bytes = 4 #Float32 unless the sample shows otherwise
+            raw = 0
+            written = 0
+            seconds = 0.0
+            finer = {} #tiles of the level before, produced for the sources of the sample
+            for tile in sampled:
+                minx, miny, maxx, maxy = tile['bounds']
+                src = settings['input_raster']
+                if i > 0 and not run_settings.get('archive'):
+                    src = estimate_level_source(tmpdir, tile, level_tiles[i-1][1], finer) #not timed, done by the level before
+                t = time.perf_counter()
+                ds = warp_to_mem(src, tile['epsg'], minx, miny, maxx, maxy, tile['xres'], tile['yres'])
+                fnam = os.path.join(tmpdir, tile['basename']+'.tif')
+                write_tile(ds, fnam, get_creation_options(run_settings.get('co_profile', 'lzw'), ds,
+                                                          run_settings.get('blocksize', 256), run_settings.get('overviews')))
+                seconds = seconds + time.perf_counter() - t
+                band = ds.GetRasterBand(1)
+                if np.any(band.ReadAsArray() != -32767):
+                    nonempty = nonempty +1
+                pixel_bytes = gdal.GetDataTypeSize(band.DataType)//8
+                raw = raw + ds.RasterXSize*ds.RasterYSize*pixel_bytes
+                written = written + os.path.getsize(fnam)
+                ds = None
+                os.remove(fnam)
+            if sampled:
+                ratio = written/float(raw) if raw else 1.0
+                est['sampled'] = len(sampled)
+                est['uncompressed_bytes'] = pixels*pixel_bytes
+                est['nonempty'] = int(round(len(tiles)*nonempty/float(len(sampled))))
+                est['compressed_bytes'] = int(est['uncompressed_bytes']*ratio)
+                est['sec_per_tile'] = seconds/len(sampled)
+                est['wall_s'] = est['sec_per_tile']*len(tiles)/max(1, jobs)
+            estimates.append(est)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        close_sources(run_settings.get('keep_open', ()))
+
+    def fmt(value, pattern, scale=1.0):
+        return "-" if value is None else pattern %(value/scale)
+    print("Estimate (%s sample tiles per level, %s job(s), creation profile %s)" %(sample, jobs, run_settings.get('co_profile', 'lzw')))
+    print("%-6s %10s %10s %16s %16s %10s %12s" %("level", "tiles", "non-empty", "uncompressed MB", "compressed MB", "sec/tile", "wall [h]"))
+    for est in estimates:
+        print("%-6s %10s %10s %16.1f %16s %10s %12s" %(est['level'], est['tiles'], fmt(est['nonempty'], "%d"), est['uncompressed_bytes']/1048576.0,
+                                                       fmt(est['compressed_bytes'], "%.1f", 1048576.0),
+                                                       fmt(est['sec_per_tile'], "%.2f"), fmt(est['wall_s'], "%.2f", 3600.0)))
+    total_bytes = sum(est['compressed_bytes'] or est['uncompressed_bytes'] for est in estimates)
+    total_wall = sum(est['wall_s'] or 0 for est in estimates)
+    free = shutil.disk_usage(run_settings['output_folder']).free
+    print("Total: %s tiles, about %.1f MB and %.2f h. %.1f MB free on the target volume%s" %(sum(est['tiles'] for est in estimates),
+          total_bytes/1048576.0, total_wall/3600.0, free/1048576.0, "" if free > total_bytes else " - NOT ENOUGH SPACE"))
+    return estimates
+
+#*--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--**--*--*--*--*
+#Following functions validate produced tiles: header (size, extent, srs, nodata, AREA_OR_POINT),
+#pixel data and sidecar of every tile, and the seams between neighbouring tiles. A DGED tile
+#includes the first row/column of its neighbours (the hanging pixel), so shared edges must match
+
+def stored_tile_filenames(output_folder, tile):
+    """
+    The names (GDAL virtual file names for a tile in an archive volume, see tile['volume']) the tif
+    and the sidecar xml of a produced tile are read from
+    """
+    folder = output_folder
+    if tile.get('volume'):
+        prefix = '/vsizip/' if tile['volume'].lower().endswith('.zip') else '/vsitar/'
+        folder = prefix + os.path.abspath(os.path.join(output_folder, tile['volume']))
+    return folder + '/' + tile['basename'] + '.tif', folder + '/' + tile['basename'] + '.xml'
+
+def vsi_checksum(fnam):
+    """
+    sha256 of a file read through GDAL (so also of a file in an archive)
+    """
+    h = hashlib.sha256()
+    f = gdal.VSIFOpenL(fnam, 'rb')
+    try:
+        for chunk in iter(lambda: gdal.VSIFReadL(1, 1024*1024, f), b''):
+            h.update(chunk)
+    finally:
+        gdal.VSIFCloseL(f)
+    return h.hexdigest()
+
+def validate_tile(task):
+    """
+    A tile (as planned, with 'checksum' from the manifest) is checked. With task['full'] False only the
+    edges are read (for the seam check of a changed neighbour). The srs is looked for in the sidecar
+    only if task['srs_keyword'] is set (the template of the run fills {{EPSG}}).
+    Returns a dict with basename, checksum, the list of problems and the edges (first/last row and column)
+    """
+    tile = task['tile']
+    namnam, xmlnam = stored_tile_filenames(task['output_folder'], tile)
+    result = {'basename': tile['basename'], 'checksum': tile.get('checksum'), 'problems': [], 'edges': None}
+    problems = result['problems']
+    ds = gdal.Open(namnam) if gdal.VSIStatL(namnam) is not None else None
+    if ds is None:
+        problems.append("tile %s can not be opened" %(namnam))
+        return result
+    minx, miny, maxx, maxy = tile['bounds']
+    band = ds.GetRasterBand(1)
+    if not task['full']: #the first/last row and column only
+        xsize, ysize = ds.RasterXSize, ds.RasterYSize
+        result['edges'] = {'top': band.ReadAsArray(0, 0, xsize, 1)[0], 'bottom': band.ReadAsArray(0, ysize-1, xsize, 1)[0],
+                           'left': band.ReadAsArray(0, 0, 1, ysize)[:, 0], 'right': band.ReadAsArray(xsize-1, 0, 1, ysize)[:, 0]}
+        return result
+    arr = band.ReadAsArray()
+    result['edges'] = {'top': arr[0, :].copy(), 'bottom': arr[-1, :].copy(),
+                       'left': arr[:, 0].copy(), 'right': arr[:, -1].copy()}
+    if tile.get('checksum') and vsi_checksum(namnam) != tile['checksum']:
+        problems.append("checksum differs from the manifest")
+    width = int(round((maxx-minx)/tile['xres']))
+    height = int(round((maxy-miny)/tile['yres']))
+    if (ds.RasterXSize, ds.RasterYSize) != (width, height):
+        problems.append("size is %sx%s posts, expected %sx%s" %(ds.RasterXSize, ds.RasterYSize, width, height))
+    ulx, xres, xskew, uly, yskew, yres = ds.GetGeoTransform()
+    tol = 1e-3*tile['xres']
+    if abs(ulx-minx) > tol or abs(uly-maxy) > tol or abs(xres-tile['xres']) > tol or abs(-yres-tile['yres']) > tol:
+        problems.append("extent (%s, %s, resolution %s, %s) does not match the plan (%s, %s, %s, %s)" %(ulx, uly, xres, -yres, minx, maxy, tile['xres'], tile['yres']))
+    if ds.GetMetadataItem('AREA_OR_POINT') != 'Point':
+        problems.append("AREA_OR_POINT is %s, expected Point" %(ds.GetMetadataItem('AREA_OR_POINT')))
+    srs = osr.SpatialReference(wkt=ds.GetProjection())
+    if not srs.IsCompound() or srs.GetAuthorityCode('VERT_CS') != '3855':
+        problems.append("srs is not compound with EPSG:3855")
+    horizontal = srs.GetAuthorityCode('PROJCS') if srs.IsProjected() else srs.GetAuthorityCode('GEOGCS')
+    if horizontal != str(tile['epsg']):
+        problems.append("horizontal srs is EPSG:%s, expected EPSG:%s" %(horizontal, tile['epsg']))
+    if band.GetNoDataValue() != -32767:
+        problems.append("nodata is %s, expected -32767" %(band.GetNoDataValue()))
+    if arr.dtype.kind == 'f' and not np.all(np.isfinite(arr)):
+        problems.append("%s pixels are NaN or infinite" %(int(np.count_nonzero(~np.isfinite(arr)))))
+    arr = None
+    ds = None
+    if gdal.VSIStatL(xmlnam) is None:
+        problems.append("sidecar %s is missing" %(xmlnam))
+    else:
+        sidecar = read_vsi(xmlnam).decode('utf-8')
+        try:
+            ET.fromstring(sidecar)
+        except ET.ParseError as e:
+            problems.append("sidecar is not valid xml: %s" %(e))
+        if '{{' in sidecar:
+            problems.append("sidecar has keywords not replaced")
+        if tile['basename'] not in sidecar:
+            problems.append("sidecar does not refer to the tile name")
+        if task.get('srs_keyword') and sidecar_epsg(tile['epsg']) not in sidecar:
+            problems.append("sidecar does not refer to the srs of the tile")
+    return result
+
+def tile_grid_index(tiles):
+    """
+    Tiles by their position in the grid: (level, epsg, column, row) counted in posts
+    """
+    index = {}
+    for tile in tiles:
+        minx, miny, maxx, maxy = tile['bounds']
+        index[(tile['level'], tile['epsg'], round(minx/tile['xres']), round(miny/tile['yres']))] = tile
+    return index
+
+def tile_neighbour(index, tile, side):
+    """
+    The neighbour (east, west, north or south) of a tile sharing an edge with it, or None
+    """
+    minx, miny, maxx, maxy = tile['bounds']
+    col = round(minx/tile['xres'])
+    row = round(miny/tile['yres'])
+    posts_x = round((maxx-minx)/tile['xres']) - 1 #the neighbour starts at the last post
+    posts_y = round((maxy-miny)/tile['yres']) - 1
+    if side == 'east':
+        return index.get((tile['level'], tile['epsg'], col + posts_x, row))
+    if side == 'north':
+        return index.get((tile['level'], tile['epsg'], col, row + posts_y))
+    if side == 'west':
+        return index.get((tile['level'], tile['epsg'], col - posts_x, row))
+    return index.get((tile['level'], tile['epsg'], col, row - posts_y))
+
+def check_seams(tiles, edges, tolerance=1e-3):
+    """
+    The shared edges of neighbouring tiles (same level and srs) are compared: the last column of a tile
+    with the first column of its eastern neighbour and the first row with the last row of its northern
+    neighbour. Pairs with different post spacing (GEO latitude bands) are not compared.
+    edges holds the edges of the tiles read (basename: edges), only pairs where both are read are checked.
+    Returns the number of seams checked and a list of problems (dicts)
+    """
+    index = tile_grid_index(tiles)
+    checked = 0
+    problems = []
+    for tile in tiles:
+        if edges.get(tile['basename']) is None:
+            continue
+        for side, mine, theirs in (('east', 'right', 'left'), ('north', 'top', 'bottom')):
+            other = tile_neighbour(index, tile, side)
+            if other is None or edges.get(other['basename']) is None or abs(other['xres']-tile['xres']) > 1e-9*tile['xres']:
+                continue
+            a = edges[tile['basename']][mine]
+            b = edges[other['basename']][theirs]
+            checked = checked +1
+            if a.shape != b.shape:
+                problems.append({'tile': tile['basename'], 'neighbour': other['basename'], 'side': side, 'problem': "edge lengths differ"})
+                continue
+            bad = int(np.count_nonzero(np.abs(a-b) > tolerance))
+            if bad:
+                problems.append({'tile': tile['basename'], 'neighbour': other['basename'], 'side': side,
+                                 'problem': "%s of %s posts differ (max %.3f)" %(bad, len(a), float(np.max(np.abs(a-b))))})
+    return checked, problems
+
+def validate_output(output_folder, manifest=MANIFEST_NAME, jobs=1, incremental=True, report_fnam=None):
+    """
+    The tiles done in the manifest are validated in parallel (jobs processes) and the seams between
+    neighbours are checked. Incrementally only tiles that are new or changed (checksum) since they last
+    passed are validated (the edges of their neighbours are read for the seam check).
+    A JSON report is written. Returns the report (dict)
+    """
+    conn = open_manifest(output_folder, manifest)
+    checksums = manifest_get_checksums(conn)
+    volumes = dict(conn.execute("SELECT basename, volume FROM tiles WHERE state='done'").fetchall())
+    tiles = manifest_get_tiles(conn, 'done')
+    for tile in tiles:
+        tile['checksum'] = checksums.get(tile['basename'])
+        tile['volume'] = volumes.get(tile['basename']) #tiles in an archive are read from their volume
+    passed = manifest_get_validated(conn) if incremental else {}
+    todo = set(tile['basename'] for tile in tiles if tile['checksum'] is None or passed.get(tile['basename']) != tile['checksum'])
+    index = tile_grid_index(tiles)
+    read = set(todo)
+    for tile in tiles:
+        if tile['basename'] in todo:
+            for side in ('east', 'west', 'north', 'south'):
+                other = tile_neighbour(index, tile, side)
+                if other is not None:
+                    read.add(other['basename'])
+    srs_keyword = {}
+    for level in set(tile['level'] for tile in tiles):
+        level_settings = manifest_load_settings(conn, level)
+        srs_keyword[level] = level_settings is not None and '{{EPSG}}' in level_settings.get('template', '')
+    tasks = [{'tile': tile, 'output_folder': output_folder, 'full': tile['basename'] in todo, 'srs_keyword': srs_keyword[tile['level']]}
+             for tile in tiles if tile['basename'] in read]
+    print("Validating %s of %s tiles using %s job(s)" %(len(todo), len(tiles), jobs))
+    if jobs > 1 and len(tasks) > 1:
+        with multiprocessing.Pool(jobs) as pool:
+            results = list(pool.imap_unordered(validate_tile, tasks, chunksize=4))
+    else:
+        results = [validate_tile(task) for task in tasks]
+    edges = dict((r['basename'], r['edges']) for r in results)
+    full = [r for r in results if r['basename'] in todo]
+    numseams, seam_problems = check_seams(tiles, edges)
+    #a seam problem is recorded for both tiles so they are checked again next time
+    for problem in seam_problems:
+        for r in full:
+            if r['basename'] in (problem['tile'], problem['neighbour']):
+                r['problems'].append("seam with %s: %s" %(problem['neighbour'] if r['basename'] == problem['tile'] else problem['tile'], problem['problem']))
+    manifest_store_validation(conn, full)
+    conn.close()
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'output_folder': os.path.abspath(output_folder),
+              'tiles': len(tiles),
+              'validated': len(full),
+              'failed': sum(1 for r in full if r['problems']),
+              'seams_checked': numseams,
+              'seam_problems': seam_problems,
+              'results': [{'basename': r['basename'], 'ok': not r['problems'], 'problems': r['problems']} for r in sorted(full, key=lambda r: r['basename'])]}
+    if report_fnam is None:
+        report_fnam = os.path.join(output_folder, "dem2dged_qa.json")
+    with open(report_fnam, 'w') as f:
+        json.dump(report, f, indent=2)
+    print("%s of %s validated tiles failed, %s of %s seams differ. Report written to %s" %(report['failed'], len(full), len(seam_problems), numseams, report_fnam))
+    return report
+
+def run_profiled(func, pargs, fnam):
+    """
+    func(pargs) is run under cProfile. The statistics are written to fnam (for e.g. snakeviz or
+    pstats) and the top functions by cumulative time are printed
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, pargs)
+    finally:
+        profiler.dump_stats(fnam)
+        print("Profile written to %s" %(fnam))
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
 def run_cmd(cmdstr):
     """
     Wrapper around subprocess.call, only so output is suppressed when not running in verbose mode.
@@ -0,0 +1,106 @@
+import argparse
+import os,sys
+import dem2dged_lib as dl
+
+parser = argparse.ArgumentParser(description="Query the run manifest of a DGED output folder and retry failed tiles")
+subparsers = parser.add_subparsers(dest="command")
+status_parser = subparsers.add_parser("status", help="Show the number of tiles in each state (planned, warping, done, failed)")
+status_parser.add_argument("output_folder", help="Output folder of a dem2dged_utm.py or dem2dged_geo.py run")
+status_parser.add_argument("-manifest",dest="manifest",help="Name of the manifest (for a node of a distributed run: dem2dged_manifest_<node_id>.sqlite)",default=dl.MANIFEST_NAME)
+status_parser.add_argument("-list_failed",action="store_true",help="List the failed tiles and their error")
+retry_parser = subparsers.add_parser("retry-failed", help="Produce the failed (and interrupted) tiles again using the settings of the last run")
+retry_parser.add_argument("output_folder", help="Output folder of a dem2dged_utm.py or dem2dged_geo.py run")
+retry_parser.add_argument("-manifest",dest="manifest",help="Name of the manifest (for a node of a distributed run: dem2dged_manifest_<node_id>.sqlite)",default=dl.MANIFEST_NAME)
+retry_parser.add_argument("-jobs",dest="jobs",type=int,help="Number of tiles produced in parallel (default is 1)",default=1)
+retry_parser.add_argument("-verbose",action="store_true",help="Show additional output")
+validate_parser = subparsers.add_parser("validate", help="Validate the produced tiles (size, extent, srs, nodata, AREA_OR_POINT, pixel data, sidecar and seams between neighbours) and write a JSON report")
+validate_parser.add_argument("output_folder", help="Output folder (or .zip/.tar archive) of a dem2dged_utm.py or dem2dged_geo.py run. Tiles in an archive are read from it directly")
+validate_parser.add_argument("-manifest",dest="manifest",help="Name of the manifest (for a node of a distributed run: dem2dged_manifest_<node_id>.sqlite)",default=dl.MANIFEST_NAME)
+validate_parser.add_argument("-jobs",dest="jobs",type=int,help="Number of tiles validated in parallel (default is 1)",default=1)
+validate_parser.add_argument("-report",dest="report",help="JSON report (default is dem2dged_qa.json in the output folder)")
+validate_parser.add_argument("-all",action="store_true",help="Validate all tiles, also those that passed before and are unchanged since")
+
+
+"""
+The manifest (dem2dged_manifest.sqlite) is written to the output folder by dem2dged_utm.py and dem2dged_geo.py.
+This script reports the state of a run, retries failed tiles and validates the produced tiles.
+The project resides on github: https://github.com/lethorable/dem2dged - please observe the license in the repository
+"""
+
+def status(pargs):
+    """
+    Number of tiles, bytes and mean production time per state
+    """
+    conn = dl.open_manifest(pargs.output_folder, pargs.manifest)
+    rows = conn.execute("SELECT state, COUNT(*), SUM(bytes), AVG(seconds) FROM tiles GROUP BY state ORDER BY state").fetchall()
+    total = sum(r[1] for r in rows)
+    print("%-10s %10s %16s %12s" %("state", "tiles", "bytes", "sec/tile"))
+    for state, count, size, seconds in rows:
+        print("%-10s %10s %16s %12s" %(state, count, size or 0, "%.2f" %(seconds) if seconds else "-"))
+    print("%-10s %10s" %("total", total))
+    if pargs.list_failed:
+        for basename, error in conn.execute("SELECT basename, error FROM tiles WHERE state='failed' ORDER BY basename"):
+            print("%s: %s" %(basename, error))
+    conn.close()
+
+def retry_failed(pargs):
+    """
+    Failed tiles and tiles left in 'warping' by an interrupted run are produced again
+    """
+    conn = dl.open_manifest(pargs.output_folder, pargs.manifest)
+    tiles = dl.manifest_get_tiles(conn, 'failed') + dl.manifest_get_tiles(conn, 'warping')
+    levels = {}
+    for tile in tiles:
+        levels.setdefault(tile['level'], []).append(tile)
+    level_settings = {}
+    for level in levels:
+        level_settings[level] = dl.manifest_load_settings(conn, level)
+        if level_settings[level] is None:
+            print("No run settings for level %s found in the manifest of %s" %(level, pargs.output_folder))
+            return 1
+    conn.close()
+    print("Retrying %s tiles" %(len(tiles)))
+    dl.debug = pargs.verbose
+    numfailed = 0
+    for level in levels:
+        run_settings = level_settings[level]
+        run_settings['output_folder'] = pargs.output_folder
+        run_settings['verbose'] = pargs.verbose
+        run_settings['distributed'] = False #failed tiles are retried on this node only
+        numfailed = numfailed + dl.run_tiles(levels[level], run_settings, pargs.jobs)
+    if numfailed > 0:
+        return 1
+    print("All done!")
+    return 0
+
+def validate(pargs):
+    """
+    The tiles done are validated. Tiles that passed before and are unchanged (checksum) are skipped
+    unless -all is given. For an archive output the manifest next to the archive is used
+    """
+    output_folder, archive = dl.split_output(pargs.output_folder)
+    manifest = pargs.manifest
+    if archive is not None and manifest == dl.MANIFEST_NAME:
+        manifest = dl.manifest_name({'archive': archive})
+    report = dl.validate_output(output_folder, manifest, pargs.jobs, not pargs.all, pargs.report)
+    for r in report['results']:
+        for problem in r['problems']:
+            print("%s: %s" %(r['basename'], problem))
+    if report['failed'] > 0:
+        return 1
+    return 0
+
+def main(args):
+    pargs = parser.parse_args(args[1:])
+    if pargs.command == "status":
+        status(pargs)
+    elif pargs.command == "retry-failed":
+        return retry_failed(pargs)
+    elif pargs.command == "validate":
+        return validate(pargs)
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -4,19 +4,44 @@ import math
 from osgeo import gdal,ogr,osr
 import subprocess
 import datetime
+import time
 import dem2dged_lib as dl
 
 debug = False
 
 parser = argparse.ArgumentParser(description="Convert a DEM to DGED UTM. The script reads a GDAL raster source and based on user input creates a set of tiles compatible with DGIWG/DGED")
-parser.add_argument("input_raster", help="Elevation raster. Must be valid gdal source (geotiff, vrt, etc.)")
-parser.add_argument("output_folder", help="Output path to the generated product")
-parser.add_argument("-utm_zone",dest="utm",help="zone for output utm (must be three letters e.g. '32N' or '09S'). If not stated, zone will be autodetected based on input raster)",default="autodetect")
-parser.add_argument("-product_level",dest="product_level",help="For UTM output must be 4b, 4, 5, 6, 7, 8 or 9 (default is level 5, GSD = 2 m)",default="5")
+parser.add_argument("input_raster", help="Elevation raster. Must be valid gdal source (geotiff, vrt, etc.). Several rasters in the same srs can be given as a comma separated list, a directory, a glob pattern (quoted) or a .txt file with one raster per line")
+parser.add_argument("output_folder", help="Output path to the generated product. A path ending in .zip or .tar is an archive the tiles and sidecars are written into as they are produced")
+parser.add_argument("-utm_zone",dest="utm",help="zone for output utm (must be three letters e.g. '32N' or '09S'). If not stated, zone will be autodetected based on input raster). Use 'all' to split inputs spanning several zones and produce a tile grid in each zone",default="autodetect")
+parser.add_argument("-product_level",dest="product_level",help="For UTM output must be 4b, 4, 5, 6, 7, 8 or 9 (default is level 5, GSD = 2 m). Several levels can be given as a comma separated list (e.g. 5,4,4b) - coarser levels are then derived from the finest",default="5")
 parser.add_argument("-xml_template",dest="xml_template",help="Template for sidecar xml file. Default to DGED_UTM_TEMPLATE.xml included in project",default="DGED_UTM_TEMPLATE.xml")
+parser.add_argument("-precedence",dest="precedence",choices=['order', 'newest', 'finest'],help="Which of several input rasters wins where they overlap: the last given (order, default), the newest file (newest) or the finest resolution (finest)",default="order")
+parser.add_argument("-keyword",dest="keyword",action="append",help="Extra keyword for the sidecar template as NAME=VALUE, replacing {{NAME}} (can be given several times)")
 parser.add_argument("-source_type", dest="source_type", help="Source type code must be a letter according to the DGED specification (default is A = optical unedited reflective surface)", default="A")
 parser.add_argument("-security_class", dest="sec_class", help="Security classification must be T, S, C, R or U (default is U)", default="U")
 parser.add_argument("-product_version", dest="prod_ver", help="Product version must be a 2 digits code (default is 01)", default="01")
+parser.add_argument("-jobs",dest="jobs",type=int,help="Number of tiles produced in parallel (default is 1)",default=1)
+parser.add_argument("-warp_threads",dest="warp_threads",type=int,help="Threads used for warping each tile (default is 0 = number of cores divided by -jobs)",default=0)
+parser.add_argument("-warp_mem",dest="warp_mem",type=int,help="Working memory of the warper in MB (default is 0 = a share of the physical memory)",default=0)
+parser.add_argument("-cache_mb",dest="cache_mb",type=int,help="GDAL block cache per process in MB (default is 0 = a share of the physical memory)",default=0)
+parser.add_argument("-writer_threads",dest="writer_threads",type=int,help="Threads compressing and writing finished tiles while the next tiles are warped (default is 0 = warp and write in turn)",default=0)
+parser.add_argument("-volume_mb",dest="volume_mb",type=int,help="Split an archive output into volumes of at most this many MB, named <archive>_001.zip, <archive>_002.zip and so on (default is 0 = one archive)",default=0)
+parser.add_argument("-strip_mb",dest="strip_mb",type=int,help="Read the source for a whole row of tiles at a time into a buffer of at most this many MB (default is 0 = read for each tile)",default=0)
+parser.add_argument("-incremental",action="store_true",help="Only produce the tiles touched by input sources (e.g. vrt members) changed since the last run into the output folder")
+parser.add_argument("-distributed",action="store_true",help="Cooperate with other nodes (hosts or processes) running the same command on the same output folder. Work is claimed through lock files in the output folder")
+parser.add_argument("-node_id",dest="node_id",help="Name of this node in distributed mode (default is hostname_pid)",default=dl.default_node_id())
+parser.add_argument("-lease_sec",dest="lease_sec",type=int,help="Claims of nodes not heard from within this many seconds are taken over in distributed mode (default is 600)",default=600)
+parser.add_argument("-no_prune",action="store_true",help="Produce all tiles within the bounding box, also tiles that do not intersect the input data")
+parser.add_argument("-co_profile",dest="co_profile",choices=sorted(dl.CREATION_PROFILES),help="GeoTIFF creation profile of the output tiles: lzw (default, LZW in strips as before), lzw_pred, deflate or zstd (predictor and internal tiling) or none",default="lzw")
+parser.add_argument("-blocksize",dest="blocksize",type=int,help="Block size of internally tiled profiles (default is 256)",default=256)
+parser.add_argument("-overviews",dest="overviews",help="Internal overview factors, comma separated e.g. 2,4,8 (default is none)")
+parser.add_argument("-plan_out",dest="plan_out",help="Only plan the tiles and write the complete plan (name, level, srs, bounds and resolution of every tile) to this file instead of producing the product. The format follows the extension: .csv, .json or .gpkg")
+parser.add_argument("-dry_run",action="store_true",help="Only estimate the number of tiles (and non-empty tiles), the output size and the wall time of the run. The estimate is calibrated on a sample of real tiles written to a temporary folder")
+parser.add_argument("-sample_tiles",dest="sample_tiles",type=int,help="Number of tiles per level sampled by -dry_run (default is 8, 0 = tile count and uncompressed size only)",default=8)
+parser.add_argument("-compare_profiles",dest="compare_profiles",type=int,help="Compare size, write and read time of the creation profiles on this many sample tiles instead of producing the product",default=0)
+parser.add_argument("-gdal_edit",action="store_true",help="Adjust the tiff header afterwards with the bundled gdal_edit.py (fallback if AREA_OR_POINT=Point is missing in the output)")
+parser.add_argument("-timing_log",dest="timing_log",help="Write the timing of every stage of every tile as JSON lines to this file and print a summary (p50, p95, max per stage and the slowest tiles) at the end")
+parser.add_argument("-profile",dest="profile",help="Run under cProfile and write the statistics to this file (only the main process is profiled, not the -jobs workers)")
 parser.add_argument("-verbose",action="store_true",help="Show additional output")
 
 
@@ -58,11 +83,7 @@ def get_recommended_srs_for_output(ext):
     center_y = (ext[1]+ext[3])/2
     my_srs   = ext[4]
     #Transform to wgs84 to do a simple estimate of UTM zone (called zone_ish)
-    source = osr.SpatialReference()
-    source.ImportFromEPSG(int(my_srs))
-    target = osr.SpatialReference()
-    target.ImportFromEPSG(4326)
-    transform = osr.CoordinateTransformation(source, target)
+    transform = dl.get_transform(my_srs, 4326, traditional=False)
     #Here Lat Lon if geographic and E N if projected... for some odd reason.
     point = ogr.CreateGeometryFromWkt("POINT (%s %s)" %(center_x,center_y))
     point.Transform(transform)
@@ -80,39 +101,44 @@ def get_recommended_srs_for_output(ext):
     dl.dp (my_srs)
     return my_srs, zone_ish
 
+def get_utm_zone_name(epsg):
+    """
+    The zone as used in the tile names (e.g. 32N) for a WGS84 UTM EPSG code
+    """
+    if epsg < 32699:
+        return str(epsg - 32600) + "N"
+    return str(epsg - 32700) + "S"
 
+def get_utm_zones_of_footprint(footprint):
+    """
+    The footprint of the input (in EPSG:4326, lon/lat) is split by UTM zone and hemisphere.
+    Returns a list of (epsg, zone name, part of the footprint in the srs of the zone)
+    """
+    zones = []
+    minlon, maxlon, minlat, maxlat = footprint.GetEnvelope()
+    for zone in range(max(1, int(math.floor((minlon+180)/6))+1), min(60, int(math.floor((maxlon+180)/6))+1)+1):
+        for NS, lat0, lat1 in (('6', 0, 90), ('7', -90, 0)):
+            if maxlat < lat0 or minlat > lat1:
+                continue
+            zone_box = dl.box_geometry(-180+(zone-1)*6, lat0, -180+zone*6, lat1)
+            part = footprint.Intersection(zone_box)
+            if part is None or part.IsEmpty() or part.GetArea() == 0:
+                continue
+            epsg = int("32"+NS+"%02d" %(zone))
+            part.Segmentize(0.1) #the zone edges are meridians, curved in the projection
+            part.Transform(dl.get_transform(4326, epsg))
+            zones.append((epsg, get_utm_zone_name(epsg), part))
+    return zones
 
-def main(args):
-    pargs = parser.parse_args(args[1:])
-    dl.debug = pargs.verbose #if verbose is set, output will be printed using the dl.dp() funcion
-    dl.checkos()
-    #create output folder if it does not exist
-    if not os.path.exists(pargs.output_folder):
-        os.makedirs(pargs.output_folder)
 
-    template = dl.read_sidecar_template(pargs.xml_template) #The template is read. Keywords are marked with {{KEYWORD}}
-    my_in_ext = dl.get_extent_and_srs_of_input_raster(pargs.input_raster)
-    dl.dp (my_in_ext)
-    my_out_srs = 0
-    utmzone = pargs.utm
-    if pargs.utm == 'autodetect':
-        my_out_srs, zone_ish = get_recommended_srs_for_output(my_in_ext)
-        if my_out_srs < 32699:
-            utmzone = str(my_out_srs - 32600) + "N"
-        else:
-            utmzone = str(my_out_srs - 32700) + "S"
-    else:
-        if pargs.utm[2].upper() == 'N': #User input should be XXB
-            my_out_srs= int("326"+pargs.utm[:-1]) #UTM N starts with 326
-        else:
-            my_out_srs= int("327"+pargs.utm[:-1]) #UTM S starts with 327
-        zone_ish = int(pargs.utm[:-1])
-    gsd, posts, tile_size_letter = resolve_level_utm(pargs.product_level)
-    dl.dp ("GSD for output is set to: %s" %(gsd))
-    dl.dp ("There are %s posts in the output files " %(posts))
-    dl.dp ("EPSG code (srs) has been set to: EPSG:%s" %(my_out_srs))
-    minx, maxx, miny, maxy = dl.get_bbox_of_output(my_in_ext,my_out_srs)
-    dl.dp ("bounding box for output has been calculated to %s %s %s %s " %(minx, maxx, miny, maxy))
+
+def plan_tiles_utm(bbox, level, epsg, utmzone, source_type, sec_class, prod_ver):
+    """
+    The tiles covering the bounding box (minx, maxx, miny, maxy) are planned.
+    Returns a list of tiles (dicts) with basename, bounds and resolution
+    """
+    minx, maxx, miny, maxy = bbox
+    gsd, posts, tile_size_letter = resolve_level_utm(level)
     tiledim = (posts-1)*gsd
     dl.dp ("Tile size is %s m by %s m" %(tiledim, tiledim))
 
@@ -121,45 +147,160 @@ def main(args):
     ix_end   = math.floor(maxx/tiledim)+1
     iy_start = math.floor(miny/tiledim)
     iy_end   = math.floor(maxy/tiledim)+1
-    numfiles = (ix_end-ix_start)*(iy_end-iy_start)
-    numdone = 0
+    tiles = []
     for yy in range(iy_start, iy_end):
         for xx in range(ix_start, ix_end):
-            numdone = numdone +1
-            percentage = int(100*numdone/numfiles)
-
             minx = xx     * (tiledim)
             maxx = (xx+1) * (tiledim) + gsd #hanging pixel
             miny = yy     * (tiledim)
             maxy = (yy+1) * (tiledim) + gsd
-#            print ("%s %s %s %s "%(minx, maxx, miny, maxy))
-            basename = "DGEDL%sUt%s_%s%s_%s_%s_%s_%s" %(pargs.product_level,tile_size_letter,utmzone,int(miny),int(minx), pargs.source_type, pargs.sec_class, pargs.prod_ver)  #should this be invoked from command line?
-            if pargs.product_level in ['4b', '4', '5', '6']:
-                basename = "DGEDL%sUt%s_%s%s_%s_%s_%s_%s" %(pargs.product_level,tile_size_letter,utmzone,int(miny/1000),int(minx/1000), pargs.source_type, pargs.sec_class, pargs.prod_ver)
-            namnam = os.path.join(pargs.output_folder,basename+'.tif')
-            xmlnam = os.path.join(pargs.output_folder,basename+'.xml')
-
-            if os.path.isfile(xmlnam):
-                print("file %s already exists, continuing (consider to delete before running)" %(xmlnam))
-                continue
+            basename = "DGEDL%sUt%s_%s%s_%s_%s_%s_%s" %(level,tile_size_letter,utmzone,int(miny),int(minx), source_type, sec_class, prod_ver)  #should this be invoked from command line?
+            if level in ['4b', '4', '5', '6']:
+                basename = "DGEDL%sUt%s_%s%s_%s_%s_%s_%s" %(level,tile_size_letter,utmzone,int(miny/1000),int(minx/1000), source_type, sec_class, prod_ver)
+            tiles.append({'basename': basename,
+                          'level': level,
+                          'row': yy,
+                          'epsg': epsg,
+                          'bounds': (minx, miny, maxx, maxy),
+                          'xres': gsd,
+                          'yres': gsd,
+                          'gsd': gsd})
+    return tiles
+
+def plan_product(input_raster, product_level="5", utm_zone="autodetect", source_type="A", sec_class="U", prod_ver="01", prune=True):
+    """
+    The tiles of one or more product levels (comma separated) are planned for the input raster
+    (see the parser for the arguments). With prune the tiles not intersecting the input data are left out.
+    Returns a list of (level, tiles) with the finest level first
+    """
+    my_in_ext = dl.get_extent_and_srs_of_input_raster(input_raster)
+    dl.dp (my_in_ext)
+    my_out_srs = 0
+    utmzone = utm_zone
+    if utm_zone == 'all':
+        my_out_srs = 4326 #the input is split by zone below
+    elif utm_zone == 'autodetect':
+        my_out_srs, zone_ish = get_recommended_srs_for_output(my_in_ext)
+        utmzone = get_utm_zone_name(my_out_srs)
+    else:
+        if utm_zone[2].upper() == 'N': #User input should be XXB
+            my_out_srs= int("326"+utm_zone[:-1]) #UTM N starts with 326
+        else:
+            my_out_srs= int("327"+utm_zone[:-1]) #UTM S starts with 327
+        zone_ish = int(utm_zone[:-1])
+    levels = sorted(product_level.split(','), key=lambda lvl: resolve_level_utm(lvl)[0]) #finest level first
+    if utm_zone == 'all':
+        #every zone gets its own grid, planned from the part of the input within the zone
+        if not prune:
+            x0, y0, x1, y1 = my_in_ext[:4]
+            if dl.get_srs(my_in_ext[4]).IsGeographic(): #the extent is flipped to lat/lon, see get_extent_and_srs_of_input_raster
+                x0, y0, x1, y1 = y0, x0, y1, x1
+            minx, miny, maxx, maxy = dl.transform_bounds(x0, y0, x1, y1, my_in_ext[4], 4326)
+            footprint = dl.box_geometry(minx, miny, maxx, maxy)
+        else:
+            footprint = dl.get_footprint_of_input_raster(input_raster, 4326)
+        zones = []
+        for epsg, zone_name, part in get_utm_zones_of_footprint(footprint):
+            minx, maxx, miny, maxy = part.GetEnvelope()
+            zones.append((epsg, zone_name, (minx, maxx, miny, maxy), part))
+        print("The input spans %s UTM zone(s): %s" %(len(zones), ", ".join(z[1] for z in zones)))
+    else:
+        dl.dp ("EPSG code (srs) has been set to: EPSG:%s" %(my_out_srs))
+        minx, maxx, miny, maxy = dl.get_bbox_of_output(my_in_ext,my_out_srs)
+        dl.dp ("bounding box for output has been calculated to %s %s %s %s " %(minx, maxx, miny, maxy))
+        footprint = None
+        if prune:
+            footprint = dl.get_footprint_of_input_raster(input_raster, my_out_srs)
+        zones = [(my_out_srs, utmzone, (minx, maxx, miny, maxy), footprint)]
+    level_tiles = []
+    for level in levels:
+        gsd, posts, tile_size_letter = resolve_level_utm(level)
+        dl.dp ("GSD for level %s output is set to: %s" %(level, gsd))
+        dl.dp ("There are %s posts in the output files " %(posts))
+        tiles = []
+        numplanned = 0
+        numpruned = 0
+        for epsg, zone_name, bbox, footprint in zones:
+            zone_tiles = plan_tiles_utm(bbox, level, epsg, zone_name, source_type, sec_class, prod_ver)
+            numplanned = numplanned + len(zone_tiles)
+            if footprint is not None:
+                zone_tiles, zone_pruned = dl.prune_tiles(zone_tiles, footprint)
+                numpruned = numpruned + zone_pruned
+            tiles = tiles + zone_tiles
+        if numpruned > 0 or prune:
+            print("Level %s: %s of %s planned tiles do not intersect the input data and are skipped" %(level, numpruned, numplanned))
+        level_tiles.append((level, tiles))
+    return level_tiles
 
-            dl.dp(" ")
-            dl.dp("-"*70)
-            dl.dp("Creating elevation raster %s" %(namnam))
-            cmdstr = """gdalwarp -t_srs EPSG:%s+3855 -te %s %s %s %s -dstnodata -32767 -tr %s %s -r cubic -co COMPRESS=LZW --config GTIFF_REPORT_COMPD_CS YES %s %s""" %(my_out_srs, minx, miny, maxx, maxy, gsd, gsd, pargs.input_raster, namnam )
-            dl.dp (cmdstr)
-            dl.run_cmd(cmdstr)
-
-            dl.dp("Adjusting tiff header")
-            cmdstr = """python gdal_edit.py --config GTIFF_REPORT_COMPD_CS YES -a_srs epsg:%s+3855 -mo AREA_OR_POINT=POINT %s""" %(my_out_srs,namnam)
-            dl.dp (cmdstr)
-            dl.run_cmd(cmdstr)
-
-            dl.dp("creating sidecar metadata file")
-            dl.write_sidecar_file(template,xmlnam,basename,pargs.product_level,gsd,"EPSG:"+str(my_out_srs))
-            dl.dp("-"*70)
-            dl.dp(" ")
-            print ("%s %% done " %(percentage))
+def main(args):
+    pargs = parser.parse_args(args[1:])
+    if pargs.profile:
+        return dl.run_profiled(convert, pargs, pargs.profile)
+    return convert(pargs)
+
+def convert(pargs):
+    """
+    The conversion itself (see the parser for the arguments)
+    """
+    dl.debug = pargs.verbose #if verbose is set, output will be printed using the dl.dp() funcion
+    if pargs.distributed and pargs.incremental:
+        parser.error("-incremental can not be combined with -distributed")
+    output_folder, archive = dl.split_output(pargs.output_folder)
+    if archive is not None and (pargs.distributed or pargs.incremental or pargs.gdal_edit):
+        parser.error("an archive output can not be combined with -distributed, -incremental or -gdal_edit")
+    dl.checkos()
+    #create output folder if it does not exist
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+
+    template = dl.read_sidecar_template(pargs.xml_template) #The template is read. Keywords are marked with {{KEYWORD}}
+    keywords = dict(k.split('=', 1) for k in pargs.keyword or [] if '=' in k)
+    try:
+        dl.compile_sidecar_template(template, keywords) #every keyword must be known before tiles are produced
+    except ValueError as e:
+        parser.error(str(e))
+    planning_started = time.time()
+    input_raster, input_sources = dl.prepare_inputs(pargs.input_raster, pargs.precedence)
+    if input_sources:
+        print("%s input rasters are converted into one tile grid" %(len(input_sources)))
+    level_tiles = plan_product(input_raster, pargs.product_level, pargs.utm, pargs.source_type, pargs.sec_class, pargs.prod_ver, not pargs.no_prune)
+    dl.add_stage_time('planning', time.time() - planning_started)
+    if pargs.plan_out:
+        numtiles = dl.write_plan(level_tiles, pargs.plan_out)
+        print("Plan of %s tiles written to %s" %(numtiles, pargs.plan_out))
+        return
+    warp_threads, warp_mem, cache_mb = dl.resolve_resources(pargs.jobs, pargs.warp_threads, pargs.warp_mem, pargs.cache_mb)
+    dl.dp ("%s job(s) with %s warp thread(s), %s MB warp memory and %s MB block cache each" %(pargs.jobs, warp_threads, warp_mem, cache_mb))
+    run_settings = {'input_raster': input_raster,
+                    'input_sources': input_sources,
+                    'output_folder': output_folder,
+                    'archive': archive,
+                    'volume_mb': pargs.volume_mb,
+                    'template': template,
+                    'gdal_edit': pargs.gdal_edit,
+                    'strip_mb': pargs.strip_mb,
+                    'distributed': pargs.distributed,
+                    'node_id': pargs.node_id,
+                    'lease_sec': pargs.lease_sec,
+                    'timing_log': pargs.timing_log,
+                    'co_profile': pargs.co_profile,
+                    'warp_threads': warp_threads,
+                    'warp_mem': warp_mem,
+                    'cache_mb': cache_mb,
+                    'writer_threads': pargs.writer_threads,
+                    'keywords': keywords,
+                    'blocksize': pargs.blocksize,
+                    'overviews': [int(f) for f in pargs.overviews.split(',')] if pargs.overviews else None,
+                    'verbose': pargs.verbose}
+    if pargs.dry_run:
+        dl.estimate_run(level_tiles, run_settings, pargs.jobs, pargs.sample_tiles)
+        return
+    if pargs.compare_profiles > 0:
+        dl.compare_creation_profiles(dl.random_tiles(level_tiles[0][1], pargs.compare_profiles), run_settings)
+        return
+    dl.run_levels(level_tiles, run_settings, pargs.jobs, pargs.incremental)
+    if pargs.timing_log:
+        dl.print_timing_summary()
     print("All done!")
 
 
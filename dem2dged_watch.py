@@ -0,0 +1,301 @@
+import argparse
+import os,sys
+import json
+import time
+import glob
+import heapq
+import shutil
+import multiprocessing
+from osgeo import gdal,osr
+import dem2dged_lib as dl
+import dem2dged_utm
+import dem2dged_geo
+
+parser = argparse.ArgumentParser(description="Watch an inbox folder and convert every delivered raster into the tiles it touches in an existing (or new) DGED product folder. Runs until stopped (Ctrl-C) with a warm pool of workers")
+parser.add_argument("inbox", help="Folder watched for new elevation rasters. Processed rasters are moved to inbox/done (or inbox/failed)")
+parser.add_argument("output_folder", help="Output path to the DGED product")
+parser.add_argument("-grid",dest="grid",choices=['utm', 'geo'],help="Product grid: utm or geo (default is utm)",default="utm")
+parser.add_argument("-product_level",dest="product_level",help="Product level(s), comma separated (default is 5)",default="5")
+parser.add_argument("-utm_zone",dest="utm",help="Zone of the UTM product (e.g. 32N). Recommended, as autodetection is done for every delivery (default is autodetect)",default="autodetect")
+parser.add_argument("-xml_template",dest="xml_template",help="Template for sidecar xml file (default is DGED_UTM_TEMPLATE.xml or DGED_GEO_TEMPLATE.xml next to this script)")
+parser.add_argument("-keyword",dest="keyword",action="append",help="Extra keyword for the sidecar template as NAME=VALUE (can be given several times)")
+parser.add_argument("-source_type", dest="source_type", help="Source type code (default is A)", default="A")
+parser.add_argument("-security_class", dest="sec_class", help="Security classification (default is U)", default="U")
+parser.add_argument("-product_version", dest="prod_ver", help="Product version (default is 01)", default="01")
+parser.add_argument("-jobs",dest="jobs",type=int,help="Number of workers in the pool, kept for the lifetime of the service (default is 1)",default=1)
+parser.add_argument("-warp_threads",dest="warp_threads",type=int,help="Threads used for warping each tile (default is 0 = number of cores divided by -jobs)",default=0)
+parser.add_argument("-warp_mem",dest="warp_mem",type=int,help="Working memory of the warper in MB (default is 0 = a share of the physical memory)",default=0)
+parser.add_argument("-cache_mb",dest="cache_mb",type=int,help="GDAL block cache per process in MB (default is 0 = a share of the physical memory)",default=0)
+parser.add_argument("-writer_threads",dest="writer_threads",type=int,help="Threads compressing and writing finished tiles while the next tiles are warped (default is 0)",default=0)
+parser.add_argument("-co_profile",dest="co_profile",choices=sorted(dl.CREATION_PROFILES),help="GeoTIFF creation profile of the output tiles (default is lzw)",default="lzw")
+parser.add_argument("-blocksize",dest="blocksize",type=int,help="Block size of internally tiled profiles (default is 256)",default=256)
+parser.add_argument("-overviews",dest="overviews",help="Internal overview factors, comma separated e.g. 2,4,8 (default is none)")
+parser.add_argument("-patterns",dest="patterns",help="File patterns picked up in the inbox, comma separated (default is *.tif,*.tiff,*.img)",default="*.tif,*.tiff,*.img")
+parser.add_argument("-poll_sec",dest="poll_sec",type=float,help="Seconds between scans of the inbox (default is 5)",default=5.0)
+parser.add_argument("-settle_sec",dest="settle_sec",type=float,help="A file is picked up when its size and time stamp have not changed for this many seconds, so files still being copied are left alone (default is 10)",default=10.0)
+parser.add_argument("-status_file",dest="status_file",help="JSON file with queue depth, throughput and the state of the service, rewritten on every scan (default is dem2dged_watch_status.json in the output folder)")
+parser.add_argument("-once",action="store_true",help="Process the rasters in the inbox and stop when it is empty")
+parser.add_argument("-verbose",action="store_true",help="Show additional output")
+
+
+"""
+Watch-folder service for dem2dged. Rasters delivered to the inbox are queued by priority and converted into
+the tiles they touch in the product folder. A touched tile is produced again from the product tiles around it
+as they are, with the delivery drawn on top, so data in the tile from outside the delivery (the original input
+or earlier deliveries) is kept. The deliveries are kept in inbox/done.
+A delivery can be given a priority in a text file next to it (<raster>.priority holding a number, lower is
+sooner, default 100). Otherwise rasters are processed in the order they arrive.
+The project resides on github: https://github.com/lethorable/dem2dged - please observe the license in the repository
+"""
+
+DEFAULT_PRIORITY = 100
+
+def read_priority(fnam):
+    """
+    The priority of a delivery (lower is sooner) from <raster>.priority, if present
+    """
+    try:
+        with open(fnam+'.priority') as f:
+            return float(f.read().strip())
+    except (OSError, ValueError):
+        return DEFAULT_PRIORITY
+
+def scan_inbox(inbox, patterns, seen, queued, settle_sec):
+    """
+    Files in the inbox that have settled (size and time stamp unchanged since the last scan and
+    older than settle_sec) are returned. seen holds (size, mtime) of files still settling
+    """
+    now = time.time()
+    ready = []
+    for pattern in patterns:
+        for fnam in glob.glob(os.path.join(inbox, pattern)):
+            if fnam in queued or not os.path.isfile(fnam):
+                continue
+            st = os.stat(fnam)
+            state = (st.st_size, st.st_mtime)
+            if seen.get(fnam) == state and now - st.st_mtime >= settle_sec:
+                del seen[fnam]
+                ready.append(fnam)
+            else:
+                seen[fnam] = state
+    return ready
+
+def write_status(fnam, status):
+    """
+    The status file is replaced atomically, so readers never see a partial file
+    """
+    status['updated'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    with open(fnam+'.part', 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(fnam+'.part', fnam)
+
+def get_epsg(fnam):
+    """
+    The EPSG code of a raster (as a string)
+    """
+    src = gdal.Open(fnam)
+    if src is None:
+        raise RuntimeError("Unable to open %s" %(fnam))
+    return osr.SpatialReference(wkt=src.GetProjection()).GetAttrValue('AUTHORITY', 1)
+
+def plan_delivery(pargs, fnam):
+    """
+    The tiles of all levels touched by a delivery (pruned to its footprint)
+    """
+    if pargs.grid == 'utm':
+        return dem2dged_utm.plan_product(fnam, pargs.product_level, pargs.utm, pargs.source_type, pargs.sec_class, pargs.prod_ver)
+    return dem2dged_geo.plan_product(fnam, pargs.product_level, pargs.source_type, pargs.sec_class, pargs.prod_ver)
+
+def move_delivery(fnam, inbox, folder):
+    """
+    A delivery (and its .priority file) is moved to a sub folder of the inbox (done or failed).
+    Returns the new path of the raster
+    """
+    target = os.path.join(inbox, folder, os.path.basename(fnam))
+    shutil.move(fnam, target)
+    if os.path.isfile(fnam+'.priority'):
+        shutil.move(fnam+'.priority', target+'.priority')
+    return target
+
+def delivery_source(fnam, epsg):
+    """
+    A delivery as an input source (see dem2dged_lib.prepare_inputs): path, extent, resolution and epsg
+    """
+    src = gdal.Open(fnam)
+    if src is None:
+        raise RuntimeError("Unable to open %s" %(fnam))
+    ulx, xres, xskew, uly, yskew, yres = src.GetGeoTransform()
+    lrx = ulx + src.RasterXSize*xres
+    lry = uly + src.RasterYSize*yres
+    return {'path': fnam, 'extent': (min(ulx,lrx), min(uly,lry), max(ulx,lrx), max(uly,lry)),
+            'res': max(abs(xres), abs(yres)), 'mtime': os.path.getmtime(fnam), 'epsg': int(epsg)}
+
+def layer_sources(output_folder, done, tiles, delivery):
+    """
+    The sources of the tiles of a level produced for a delivery, in precedence order: the product tiles
+    done around them, with the delivery on top
+    """
+    around = (min(tile['bounds'][0] for tile in tiles), min(tile['bounds'][1] for tile in tiles),
+              max(tile['bounds'][2] for tile in tiles), max(tile['bounds'][3] for tile in tiles))
+    sources = []
+    for tile in dl.get_touched_tiles(done, [around], delivery['epsg']):
+        namnam = os.path.join(output_folder, tile['basename']+'.tif')
+        if os.path.isfile(namnam):
+            sources.append({'path': namnam, 'extent': tile['bounds'], 'res': max(tile['xres'], tile['yres']),
+                            'mtime': os.path.getmtime(namnam), 'epsg': int(tile['epsg'])})
+    return sources + [delivery]
+
+def process_delivery(pargs, fnam, run_settings, pool, status, status_file):
+    """
+    The tiles a delivery touches, and the tiles within reach of the cubic kernel around it, are produced
+    (again) from the product tiles with the delivery on top. The delivery must be in the srs of the product.
+    Returns the number of tiles produced and the number of failed tiles
+    """
+    started = time.time()
+    inbox = os.path.dirname(fnam)
+    conn = dl.open_manifest(pargs.output_folder)
+    try:
+        try:
+            epsg = get_epsg(fnam)
+            product = sorted(str(code) for code in dl.manifest_get_epsgs(conn))
+            if product and epsg not in product:
+                raise RuntimeError("%s (EPSG:%s) is not in the srs of the product (EPSG:%s)" %(fnam, epsg, ", EPSG:".join(product)))
+        except Exception:
+            move_delivery(fnam, inbox, 'failed') #otherwise it is picked up again by the next scan
+            raise
+        target = move_delivery(fnam, inbox, 'done')
+        try:
+            level_tiles = plan_delivery(pargs, target)
+            delivery = delivery_source(target, epsg)
+        except Exception:
+            move_delivery(target, inbox, 'failed')
+            raise
+        minx, miny, maxx, maxy = delivery['extent']
+        halo = 2*delivery['res'] #the cubic kernel in the delivery, get_touched_tiles adds it in the tiles
+        reach = [(minx-halo, miny-halo, maxx+halo, maxy+halo)]
+        numtiles = 0
+        numfailed = 0
+        for level, tiles in level_tiles:
+            known = [tile for tile in dl.manifest_get_tiles(conn) if str(tile['level']) == str(level)]
+            planned = set(tile['basename'] for tile in tiles)
+            tiles = tiles + [tile for tile in dl.get_touched_tiles(known, reach, delivery['epsg']) if tile['basename'] not in planned]
+            if not tiles:
+                continue
+            done = dl.manifest_get_basenames(conn, 'done')
+            sources = layer_sources(pargs.output_folder, [tile for tile in known if tile['basename'] in done], tiles, delivery)
+            dl.manifest_reset_tiles(conn, [tile['basename'] for tile in tiles]) #tiles done before are produced again with the new data
+            delivery_settings = dict(run_settings)
+            delivery_settings['input_raster'] = target
+            delivery_settings['input_sources'] = sources
+            delivery_settings['delivery'] = "%s %s" %(os.path.basename(fnam), started) #workers reopen the sources for a new delivery
+            status['current'] = {'raster': os.path.basename(fnam), 'level': level, 'tiles': len(tiles)}
+            write_status(status_file, status)
+            numfailed = numfailed + dl.run_tiles(tiles, delivery_settings, pargs.jobs, pool)
+            numtiles = numtiles + len(tiles)
+    finally:
+        conn.close()
+    return numtiles, numfailed
+
+def main(args):
+    pargs = parser.parse_args(args[1:])
+    dl.debug = pargs.verbose
+    for folder in (pargs.output_folder, os.path.join(pargs.inbox, 'done'), os.path.join(pargs.inbox, 'failed')):
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+    if pargs.xml_template is None:
+        pargs.xml_template = os.path.join(os.path.dirname(os.path.abspath(__file__)), #next to this script, not in the working directory
+                                          "DGED_UTM_TEMPLATE.xml" if pargs.grid == 'utm' else "DGED_GEO_TEMPLATE.xml")
+    template = dl.read_sidecar_template(pargs.xml_template) #read once for the lifetime of the service
+    keywords = dict(k.split('=', 1) for k in pargs.keyword or [] if '=' in k)
+    try:
+        dl.compile_sidecar_template(template, keywords)
+    except ValueError as e:
+        parser.error(str(e))
+    warp_threads, warp_mem, cache_mb = dl.resolve_resources(pargs.jobs, pargs.warp_threads, pargs.warp_mem, pargs.cache_mb)
+    run_settings = {'input_raster': None,
+                    'output_folder': pargs.output_folder,
+                    'template': template,
+                    'gdal_edit': False,
+                    'strip_mb': 0,
+                    'distributed': False,
+                    'node_id': None,
+                    'lease_sec': 600,
+                    'timing_log': None,
+                    'co_profile': pargs.co_profile,
+                    'warp_threads': warp_threads,
+                    'warp_mem': warp_mem,
+                    'cache_mb': cache_mb,
+                    'writer_threads': pargs.writer_threads,
+                    'keywords': keywords,
+                    'blocksize': pargs.blocksize,
+                    'overviews': [int(f) for f in pargs.overviews.split(',')] if pargs.overviews else None,
+                    'verbose': pargs.verbose}
+    status_file = pargs.status_file or os.path.join(pargs.output_folder, "dem2dged_watch_status.json")
+    status = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'state': 'idle',
+              'queue_depth': 0,
+              'queue': [],
+              'current': None,
+              'rasters_done': 0,
+              'rasters_failed': 0,
+              'tiles_done': 0,
+              'tiles_failed': 0,
+              'busy_seconds': 0.0,
+              'tiles_per_s': None,
+              'last_error': None}
+    patterns = [p for p in pargs.patterns.split(',') if p]
+    pool = None
+    if pargs.jobs > 1: #kept warm for all deliveries
+        pool = multiprocessing.Pool(pargs.jobs, initializer=dl.init_worker, initargs=(run_settings,))
+    heap = []
+    queued = set()
+    seen = {}
+    print("Watching %s (every %s s), producing into %s" %(pargs.inbox, pargs.poll_sec, pargs.output_folder))
+    try:
+        while True:
+            for fnam in scan_inbox(pargs.inbox, patterns, seen, queued, pargs.settle_sec):
+                heapq.heappush(heap, (read_priority(fnam), time.time(), fnam))
+                queued.add(fnam)
+                print("Queued %s" %(fnam))
+            status['queue_depth'] = len(heap)
+            status['queue'] = [os.path.basename(entry[2]) for entry in sorted(heap)]
+            if heap:
+                priority, arrived, fnam = heapq.heappop(heap)
+                queued.discard(fnam)
+                status['state'] = 'working'
+                status['queue_depth'] = len(heap)
+                status['queue'] = [os.path.basename(entry[2]) for entry in sorted(heap)]
+                started = time.time()
+                print("Processing %s (priority %s)" %(fnam, priority))
+                try:
+                    numtiles, numfailed = process_delivery(pargs, fnam, run_settings, pool, status, status_file)
+                    status['rasters_done'] += 1
+                    status['tiles_done'] += numtiles - numfailed
+                    status['tiles_failed'] += numfailed
+                except Exception as e:
+                    print("Delivery %s failed: %s" %(fnam, e))
+                    status['rasters_failed'] += 1
+                    status['last_error'] = "%s: %s" %(os.path.basename(fnam), e)
+                status['busy_seconds'] += time.time() - started
+                status['tiles_per_s'] = status['tiles_done']/status['busy_seconds'] if status['busy_seconds'] > 0 else None
+                status['current'] = None
+                write_status(status_file, status)
+                continue #look for more work before sleeping
+            status['state'] = 'idle'
+            write_status(status_file, status)
+            if pargs.once and not seen:
+                break
+            time.sleep(pargs.poll_sec)
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        status['state'] = 'stopped'
+        write_status(status_file, status)
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,94 @@
+"""
+Archive output interrupted mid-volume and resumed (see dem2dged_lib.repair_volume and open_archive)
+"""
+import os,sys
+import zipfile
+import pytest
+
+pytest.importorskip("osgeo")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import dem2dged_lib as dl
+
+NUMTILES = 6
+CHECKPOINTED = 3 #tiles added before the checkpoint, the next two are added after it
+
+def make_tile(i):
+    return {'basename': "tile_%02d" %(i), 'level': '6', 'epsg': 32632, 'row': 0, 'bounds': (i, 0, i+1, 1),
+            'xres': 1, 'yres': 1, 'gsd': 1}
+
+def make_result(i):
+    data = bytes([i+1])*(3000 + 7*i)
+    return {'basename': "tile_%02d" %(i), 'state': 'done', 'timings': {}, 'bytes': len(data), 'checksum': str(i),
+            'data': data, 'sidecar': "<tile>%s</tile>" %(i)}
+
+def expected_entries(count):
+    entries = {}
+    for i in range(count):
+        result = make_result(i)
+        entries[result['basename']+'.tif'] = result['data']
+        entries[result['basename']+'.xml'] = result['sidecar'].encode('utf-8')
+    return entries
+
+def read_entries(fnam):
+    with dl.open_volume(fnam, 'r') as handle:
+        if isinstance(handle, zipfile.ZipFile):
+            assert handle.testzip() is None
+            return dict((name, handle.read(name)) for name in handle.namelist())
+        return dict((member.name, handle.extractfile(member).read()) for member in handle.getmembers())
+
+def interrupted_run(folder, ext, cut):
+    """
+    Tiles are added to an archive with a checkpoint after the first ones, then the volume is cut at
+    cut(checkpoint, end) as if the run had been killed. Returns the archive, manifest and checkpoint
+    """
+    archive = os.path.join(folder, "product"+ext)
+    conn = dl.open_manifest(folder, dl.manifest_name({'archive': archive}))
+    dl.manifest_add_tiles(conn, [make_tile(i) for i in range(NUMTILES)])
+    state = dl.open_archive(archive, 0, conn)
+    for i in range(CHECKPOINTED):
+        dl.archive_add(state, conn, make_result(i))
+    dl.archive_checkpoint(state, conn)
+    checkpoint = dl.volume_data_end(state['handle'])
+    for i in range(CHECKPOINTED, CHECKPOINTED+2):
+        dl.archive_add(state, conn, make_result(i))
+    end = dl.volume_data_end(state['handle'])
+    state['handle'].close()
+    os.truncate(archive, cut(checkpoint, end))
+    return archive, conn, checkpoint
+
+def finish_run(archive, conn):
+    state = dl.open_archive(archive, 0, conn)
+    done = dl.manifest_get_basenames(conn, 'done')
+    for i in range(NUMTILES):
+        if make_tile(i)['basename'] not in done:
+            dl.archive_add(state, conn, make_result(i))
+    dl.archive_checkpoint(state, conn, close=True)
+    assert dl.manifest_get_basenames(conn, 'done') == set(make_tile(i)['basename'] for i in range(NUMTILES))
+    assert read_entries(archive) == expected_entries(NUMTILES)
+
+@pytest.mark.parametrize("ext", [".zip", ".tar"])
+@pytest.mark.parametrize("cut", [lambda checkpoint, end: checkpoint + 700, #within the first entry after the checkpoint
+                                 lambda checkpoint, end: end], #after the last entry, without index or end marker
+                         ids=["mid_entry", "after_last_entry"])
+def test_truncated_volume_is_resumed_from_its_checkpoint(tmp_path, ext, cut):
+    archive, conn, checkpoint = interrupted_run(str(tmp_path), ext, cut)
+    state = dl.open_archive(archive, 0, conn)
+    assert state['name'] == archive and state['number'] == 1
+    assert dl.volume_is_closed(archive, checkpoint)
+    assert conn.execute("SELECT data_end FROM volumes WHERE name=?", (os.path.basename(archive),)).fetchone()[0] == checkpoint
+    done = dl.manifest_get_basenames(conn, 'done')
+    assert done == set(make_tile(i)['basename'] for i in range(CHECKPOINTED))
+    assert read_entries(archive) == expected_entries(CHECKPOINTED)
+    for basename in done:
+        assert conn.execute("SELECT volume FROM tiles WHERE basename=?", (basename,)).fetchone()[0] == os.path.basename(archive)
+    finish_run(archive, conn)
+
+@pytest.mark.parametrize("ext", [".zip", ".tar"])
+def test_volume_cut_before_its_checkpoint_is_produced_again(tmp_path, ext):
+    archive, conn, checkpoint = interrupted_run(str(tmp_path), ext, lambda checkpoint, end: checkpoint - 100)
+    dl.open_archive(archive, 0, conn)
+    assert os.path.isfile(archive+'.broken') and not os.path.exists(archive)
+    assert not dl.manifest_get_basenames(conn, 'done')
+    assert conn.execute("SELECT COUNT(*) FROM volumes").fetchone()[0] == 0
+    finish_run(archive, conn)
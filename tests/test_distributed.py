@@ -0,0 +1,82 @@
+"""
+Distributed mode with several local processes standing in for nodes (see dem2dged_lib.try_claim)
+"""
+import os,sys
+import glob
+import time
+import subprocess
+import multiprocessing
+import pytest
+
+pytest.importorskip("osgeo")
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import dem2dged_lib as dl
+
+KEYS = ["tile_%03d" %(i) for i in range(60)]
+
+def use_queue(output_folder, node_id, lease_sec=60):
+    dl.settings = {'output_folder': output_folder, 'node_id': node_id, 'lease_sec': lease_sec}
+    os.makedirs(os.path.join(output_folder, dl.QUEUE_DIR), exist_ok=True)
+
+def claim_all(output_folder, node_id, barrier, keys):
+    use_queue(output_folder, node_id)
+    barrier.wait()
+    with open(os.path.join(output_folder, node_id+".claimed"), 'w') as f:
+        for key in keys:
+            if dl.try_claim(key):
+                f.write(key+"\n")
+
+def claim_stale(output_folder, node_id, barrier, key):
+    use_queue(output_folder, node_id)
+    barrier.wait()
+    if dl.try_claim(key):
+        with open(os.path.join(output_folder, node_id+".claimed"), 'w') as f:
+            f.write(key+"\n")
+
+def run_nodes(target, output_folder, arg, nodes=4):
+    ctx = multiprocessing.get_context('fork')
+    barrier = ctx.Barrier(nodes)
+    procs = [ctx.Process(target=target, args=(output_folder, "node%s" %(i), barrier, arg)) for i in range(nodes)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join(60)
+        assert p.exitcode == 0
+    claimed = []
+    for fnam in glob.glob(os.path.join(output_folder, "*.claimed")):
+        with open(fnam) as f:
+            claimed = claimed + f.read().split()
+    return claimed
+
+def test_every_tile_is_claimed_by_one_node(tmp_path):
+    keys = list(KEYS)
+    claimed = run_nodes(claim_all, str(tmp_path), keys)
+    assert sorted(claimed) == sorted(keys)
+
+def test_stale_claim_is_taken_over_by_one_node(tmp_path):
+    use_queue(str(tmp_path), "dead")
+    fnam = dl.queue_path("tile_stale.claim")
+    with open(fnam, 'w') as f:
+        f.write("dead 0")
+    old = time.time() - 3600
+    os.utime(fnam, (old, old))
+    claimed = run_nodes(claim_stale, str(tmp_path), "tile_stale", nodes=6)
+    assert claimed == ["tile_stale"]
+    assert time.time() - os.path.getmtime(fnam) < 60
+
+def test_nodes_produce_every_tile_once(tmp_path):
+    output_folder = str(tmp_path / "product")
+    cmd = [sys.executable, os.path.join(ROOT, "dem2dged_utm.py"), os.path.join(ROOT, "test.tif"), output_folder,
+           "-product_level", "6", "-xml_template", os.path.join(ROOT, "DGED_UTM_TEMPLATE.xml"), "-distributed", "-lease_sec", "30"]
+    os.makedirs(output_folder)
+    procs = [subprocess.Popen(cmd + ["-node_id", "node%s" %(i)], cwd=ROOT, stdout=subprocess.DEVNULL) for i in range(3)]
+    for p in procs:
+        assert p.wait(600) == 0
+    tifs = sorted(os.path.basename(f)[:-4] for f in glob.glob(os.path.join(output_folder, "*.tif")))
+    done = sorted(os.path.basename(f)[:-5] for f in glob.glob(os.path.join(output_folder, dl.QUEUE_DIR, "*.done")))
+    assert tifs and tifs == done
+    for basename in tifs:
+        assert os.path.isfile(os.path.join(output_folder, basename+".xml"))
+    assert not glob.glob(os.path.join(output_folder, "*.part*"))
+    assert not glob.glob(os.path.join(output_folder, dl.QUEUE_DIR, "*.claim"))